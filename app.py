@@ -1,18 +1,47 @@
-from dash import Dash, html, dcc, Input, Output, State
+from dash import Dash, html, dcc, Input, Output, State, ClientsideFunction
+from flask import send_from_directory, jsonify, request, Response, abort
 import pandas as pd
+import os
 import plotly.express as px
 from dash import dash_table
 from src.visualization.data_graph import DataGraph
+from src.visualization.figure_cache import FigureCache
+from src.visualization.vector_tiles import VectorTiles
 
 # Initialize the Dash app
 app = Dash(__name__, suppress_callback_exceptions=True, meta_tags=[{"name": "viewport", "content": "width=device-width, initial-scale=1.0"}])
 app.title = "Road Infrastructure & Its Effects on Commute Time"
 server = app.server
 
-# Data initialization
-data = DataGraph()
+@server.route("/geojson/<path:filename>")
+def geojson(filename):
+    # prebuilt by DataProcess.process_geojson; browsers cache it and revalidate with the ETag
+    return send_from_directory(os.path.abspath("data/processed/geojson"), filename,
+                               mimetype="application/geo+json", max_age=86400)
+
+@server.route("/tiles/<int:sex>/<race>/<mode>/<int:year>/<int:group>/<int:z>/<int:x>/<int:y>.pbf")
+def vector_tile(sex, race, mode, year, group, z, x, y):
+    if mode not in DataGraph.modes:
+        abort(404)
+    # one layer per color bin: the tile only holds the PUMAs whose value falls in the bin
+    _, groups = data.bins(sex, race, mode, year)
+    tile = tiles.tile(z, x, y, groups[group] if group < len(groups) else set())
+    return Response(tile, mimetype="application/vnd.mapbox-vector-tile", headers={"Cache-Control": "public, max-age=86400"})
+
+@server.route("/metrics/figures")
+def figure_metrics():
+    # the workers keep the data they loaded, so a refresh needs a restart to be served
+    return jsonify(dict(figures.stats(), restart_needed=data.version()[:16] != figures.version))
+
+# Data initialization: the attribute table is memory-mapped and shared by all workers,
+# or queried from an SQLite file when GRAPH_DATABASE is set; geometries are read per state on first use
+data = DataGraph(lazy=True, database=os.environ.get("GRAPH_DATABASE"))
+# keyed on the version loaded above: figures follow a data refresh once the workers restart
+figures = FigureCache(data.version())
+tiles = VectorTiles()
+print("\033[0;32mINFO: \033[0m" + "Startup " + ", ".join(f"{step} {seconds:.2f}s" for step, seconds in data.timings.items()))
 state_codes = pd.read_parquet("data/external/state_codes.parquet").sort_values(by='fips')
-state_options = [{'label': state_name, 'value': state_code} for state_name, state_code in zip(state_codes['state_name'], state_codes['fips'])]
+state_options = [{'label': 'United States', 'value': 0}] + [{'label': state_name, 'value': state_code} for state_name, state_code in zip(state_codes['state_name'], state_codes['fips'])]
 
 # Load the CSV file
 all_data = pd.read_csv("data/processed/all.csv")
@@ -104,6 +133,7 @@ def render_content(tab):
                 html.Button('Update Graph', id='update-graph-btn', n_clicks=0)
             ], style={'width': '50%', 'margin': 'auto', 'text-align': 'center', 'padding': '10px'}),
 
+            dcc.Store(id='map-values'),
             dcc.Graph(
                 id='map-graph',
                 style={'width': '100%', 'height': '80vh'}
@@ -152,9 +182,11 @@ def render_content(tab):
             '''),
         ], style={'width': '70%', 'margin': 'auto'})
 
-# Callback to update the map graph based on the selected options
+# Callback to update the map graph based on the selected options; it also sends the
+# year x mode values of the selection once so the slider and mode dropdown recolor client-side
 @app.callback(
-    Output('map-graph', 'figure'),
+    [Output('map-graph', 'figure'),
+     Output('map-values', 'data')],
     [Input('update-graph-btn', 'n_clicks')],
     [State('state-dropdown', 'value'),
      State('sex-dropdown', 'value'),
@@ -163,18 +195,25 @@ def render_content(tab):
      State('year-slider', 'value')]
 )
 def update_figure(n_clicks, state, sex, race, mode, year):
-    df = data.graph(state, sex, race)
-    df = df[df['year'] == year]  # Filter data for the selected year
-    
-    fig = px.choropleth_mapbox(df,
-                                geojson=df.geometry,
-                                locations=df.index,
-                                color=mode,
-                                center={"lat": 37.0902, "lon": -95.7129},
-                                mapbox_style="carto-positron",
-                                color_continuous_scale="Viridis",
-                                zoom=3)
-    return fig
+    params = {"state": state, "sex": sex, "race": race, "mode": mode, "year": year}
+    if state == 0:
+        # vector tile sources need absolute URLs; the national bins are computed on the server
+        params["origin"] = request.host_url.rstrip("/")
+        return figures.get(params, lambda: data.figure(**params)), None
+    values = {"state": state, "sex": sex, "race": race, "payload": True}
+    return (figures.get(params, lambda: data.figure(**params)),
+            figures.get(values, lambda: data.payload(state, sex, race)))
+
+# Recolor the map in the browser when the year or mode changes
+app.clientside_callback(
+    ClientsideFunction(namespace='map', function_name='recolor'),
+    Output('map-graph', 'figure', allow_duplicate=True),
+    [Input('year-slider', 'value'),
+     Input('mode-dropdown', 'value')],
+    [State('map-values', 'data'),
+     State('map-graph', 'figure')],
+    prevent_initial_call=True
+)
 
 # Run the app
 if __name__ == '__main__':
@@ -0,0 +1,26 @@
+// Recolors the state choropleth from the values sent once by the update_figure callback,
+// so moving the year slider or switching the travel mode needs no server round-trip.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    map: {
+        recolor: function(year, mode, payload, figure) {
+            if (!payload || !figure || !figure.data || !figure.data.length) {
+                return window.dash_clientside.no_update;
+            }
+            const row = payload.years.indexOf(year);
+            const values = payload.values[mode];
+            if (row < 0 || !values) {
+                return window.dash_clientside.no_update;
+            }
+            const trace = Object.assign({}, figure.data[0], {
+                locations: payload.puma_ids,
+                z: values[row],
+                hovertemplate: "puma_id=%{location}<br>" + mode + "=%{z}<extra></extra>"
+            });
+            const layout = Object.assign({}, figure.layout);
+            const coloraxis = Object.assign({}, layout.coloraxis);
+            coloraxis.colorbar = Object.assign({}, coloraxis.colorbar, {title: {text: mode}});
+            layout.coloraxis = coloraxis;
+            return Object.assign({}, figure, {data: [trace].concat(figure.data.slice(1)), layout: layout});
+        }
+    }
+});
@@ -1,10 +1,8 @@
-from src.data.data_pull import DataPull
-from src.data.data_process import DataProcess
+from src.data.data_pipeline import DataPipeline
 
 def main() -> None:
-    DataPull(debug=True)
-    DataProcess(debug=True)
-    #DAO()
+    DataPipeline(debug=True).run()
+    #DataPipeline(debug=True, database=True).run()
 
 if __name__ == "__main__":
     main()
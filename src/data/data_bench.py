@@ -0,0 +1,288 @@
+from src.data.data_process import DataProcess
+import polars as pl
+import numpy as np
+import tempfile
+import shapely
+import time
+import os
+
+
+class DataBench(DataProcess):
+    """
+    A class to benchmark the optimized processing steps against their original
+    implementations on the same inputs.
+
+    Parameters
+    ----------
+    debug : bool, optional
+        If True, enables debug messages. The default is False.
+    """
+
+    def __init__(self, debug=False, **kwargs):
+        super().__init__(debug=debug, **kwargs)
+
+    @staticmethod
+    def timed(func, *args) -> tuple:
+        """
+        Runs a function and measures its wall-clock time.
+
+        Returns
+        -------
+        tuple
+            The result of the function and the elapsed seconds.
+        """
+        start = time.perf_counter()
+        result = func(*args)
+        return result, time.perf_counter() - start
+
+    def clip_length(self, roads, state_id: str, year: int) -> pl.DataFrame:
+        """
+        The original road length computation, clipping the whole state's roads against
+        every PUMA polygon in turn.
+        """
+        pumas = self.pumas[self.pumas["puma_id"].str.startswith(str(state_id).zfill(2))]
+        rows = []
+        for puma_id, geometry in zip(pumas["puma_id"], pumas["geometry"]):
+            clipped = roads.clip(geometry)
+            rows.append((year, str(state_id).zfill(2), puma_id, clipped.length.sum()))
+        return pl.DataFrame(rows, schema=["year", "state_id", "puma_id", "length"], orient="row")
+
+    def bench_length(self, state_id: str, year: int) -> dict:
+        """
+        Compares the STRtree overlay in `process_length` with the original clip loop.
+
+        Parameters
+        ----------
+        state_id : str
+            The state identifier.
+        year : int
+            The year of the road data.
+
+        Returns
+        -------
+        dict
+            The timings of both implementations and the speedup.
+        """
+        roads = self.read_roads(state_id, year, self.debug)
+        empty_df = [
+            pl.Series("year", [], dtype=pl.Int64),
+            pl.Series("state_id", [], dtype=pl.String),
+            pl.Series("puma_id", [], dtype=pl.String),
+            pl.Series("length", [], dtype=pl.Float64),
+        ]
+        new, new_time = self.timed(self.process_length, roads, state_id, year, empty_df)
+        old, old_time = self.timed(self.clip_length, roads, state_id, year)
+
+        joined = old.join(new, on="puma_id", suffix="_new")
+        assert np.allclose(joined["length"].to_numpy(), joined["length_new"].to_numpy(), rtol=1e-9, atol=1e-9)
+
+        result = {"clip": old_time, "overlay": new_time, "speedup": old_time / max(new_time, 1e-9)}
+        print("\033[0;32mBENCH: \033[0m" + f"Road length for {str(state_id).zfill(2)} {year}: "
+              f"clip {old_time:.2f}s, overlay {new_time:.2f}s, {result['speedup']:.1f}x faster")
+        return result
+
+    def bench_incremental(self, state_id: str, years=range(2012, 2020)) -> dict:
+        """
+        Compares the incremental year-over-year road lengths with a full recompute of every year.
+
+        Parameters
+        ----------
+        state_id : str
+            The state identifier.
+        years : list, optional
+            The consecutive years to compute. The default is 2012 through 2019.
+
+        Returns
+        -------
+        dict
+            The timings of both implementations and the speedup.
+        """
+        pumas = self.pumas[self.pumas["puma_id"].str.startswith(str(state_id).zfill(2))]
+        puma_ids = pumas["puma_id"].tolist()
+        puma_wkb = shapely.to_wkb(pumas.geometry.to_numpy())
+
+        def full() -> pl.DataFrame:
+            return pl.concat([pl.read_ipc(self.road_length_partition(state_id, year, puma_ids, puma_wkb))
+                              for year in years])
+
+        old, old_time = self.timed(full)
+        new, new_time = self.timed(lambda: pl.read_ipc(self.road_length_state(state_id, list(years), puma_ids, puma_wkb)))
+
+        joined = old.join(new, on=["year", "puma_id"], suffix="_new")
+        assert np.allclose(joined["length"].to_numpy(), joined["length_new"].to_numpy(), rtol=1e-6, atol=1e-6)
+
+        result = {"full": old_time, "incremental": new_time, "speedup": old_time / max(new_time, 1e-9)}
+        print("\033[0;32mBENCH: \033[0m" + f"Road length for {str(state_id).zfill(2)} {years[0]}-{years[-1]}: "
+              f"full {old_time:.2f}s, incremental {new_time:.2f}s, {result['speedup']:.1f}x faster")
+        return result
+
+    @staticmethod
+    def legacy_acs(files: list, deflators: pl.DataFrame) -> pl.DataFrame:
+        """
+        The original ACS aggregation, filtering and grouping every (sex, race) subgroup separately.
+        Income is adjusted with the same deflators as `aggregate_acs` so the outputs are comparable.
+        """
+        deflator = dict(deflators.select("year", "deflator").rows())
+        frames = []
+        for file in files:
+            original = pl.read_parquet(file)
+            for sex in [1, 2, 3]:
+                for race in ["RACAIAN", "RACASN", "RACBLK", "RACNUM", "RACWHT", "RACSOR", "HISP", "ALL"]:
+                    df = original
+                    if sex != 3:
+                        df = df.filter(pl.col("SEX") == sex)
+                    if race != "ALL":
+                        df = df.filter(pl.col(race) == 1)
+                    df = df.filter(pl.col("JWMNP") > 0)
+                    if df.is_empty():
+                        continue
+                    df = df.with_columns(
+                        pl.when(pl.col("JWTR") == k).then(pl.col("PWGTP")).otherwise(0).alias(mode)
+                        for k, mode in enumerate(["car", "bus", "streetcar", "subway", "railroad", "ferry", "taxi",
+                                                  "motorcycle", "bicycle", "walking", "home", "other"], start=1)
+                    )
+                    df = df.with_columns(total_time=(pl.col("PWGTP") * pl.col("JWMNP")))
+                    year = df.select(pl.col("year")).unique().item()
+                    df = df.group_by("year", "state", "PUMA").agg(
+                        pl.col("PWGTP", "total_time", "car", "bus", "streetcar", "subway", "railroad",
+                               "ferry", "taxi", "motorcycle", "bicycle", "walking", "home", "other").sum(),
+                        DataProcess.adjust_income(pl.lit(deflator[year])).median()
+                    )
+                    df = df.with_columns(
+                        (pl.col("total_time") / pl.col("PWGTP")).alias("avg_time"),
+                        sex=pl.lit(sex),
+                        race=pl.lit(race),
+                    )
+                    frames.append(df)
+        return pl.concat(frames, how="vertical")
+
+    def bench_acs(self, files=None) -> dict:
+        """
+        Checks that the single-pass ACS aggregation reproduces the original per-subgroup
+        loop exactly and compares their timings.
+
+        Parameters
+        ----------
+        files : list, optional
+            The raw ACS parquet files to aggregate. The default is every acs_*.parquet in data/raw.
+
+        Returns
+        -------
+        dict
+            The timings of both implementations and the speedup.
+        """
+        files = files or sorted(f"data/raw/{file}" for file in os.listdir("data/raw") if file.startswith("acs"))
+        keys = ["year", "state", "PUMA", "sex", "race"]
+        deflators = self.pull_cpi()
+        old, old_time = self.timed(self.legacy_acs, files, deflators)
+        new, new_time = self.timed(lambda: self.aggregate_acs(pl.scan_parquet(files), deflators).collect())
+
+        old = old.sort(keys)
+        new = new.select(old.columns).sort(keys)
+        assert old.equals(new), "single-pass ACS aggregation differs from the original loop"
+
+        result = {"loop": old_time, "single_pass": new_time, "speedup": old_time / max(new_time, 1e-9)}
+        print("\033[0;32mBENCH: \033[0m" + f"ACS aggregation of {len(files)} files: "
+              f"loop {old_time:.2f}s, single pass {new_time:.2f}s, {result['speedup']:.1f}x faster")
+        return result
+
+    def bench_stream_acs(self, files=None, memory_budget=64) -> dict:
+        """
+        Checks that the streaming ACS aggregation writes the same rows as the in-memory
+        query and compares their timings.
+
+        Parameters
+        ----------
+        files : list, optional
+            The raw ACS parquet files to aggregate. The default is every acs_*.parquet in data/raw.
+        memory_budget : int, optional
+            The memory budget in MB of a streaming batch. The default is 64.
+
+        Returns
+        -------
+        dict
+            The timings of both implementations.
+        """
+        files = files or sorted(f"data/raw/{file}" for file in os.listdir("data/raw") if file.startswith("acs"))
+        keys = ["year", "state", "PUMA", "sex", "race"]
+        deflators = self.pull_cpi()
+        old, old_time = self.timed(lambda: self.aggregate_acs(pl.scan_parquet(files), deflators).collect())
+
+        self.memory_budget = memory_budget
+        with tempfile.TemporaryDirectory() as directory:
+            output = f"{directory}/acs.parquet"
+            _, new_time = self.timed(self.stream_acs, files, output, old.schema)
+            new = pl.read_parquet(output)
+
+        assert old.sort(keys).equals(new.sort(keys)), "streaming ACS aggregation differs from the in-memory query"
+
+        result = {"in_memory": old_time, "streaming": new_time}
+        print("\033[0;32mBENCH: \033[0m" + f"ACS aggregation of {len(files)} files: "
+              f"in memory {old_time:.2f}s, streaming {new_time:.2f}s with a {memory_budget} MB budget")
+        return result
+
+    @staticmethod
+    def legacy_roads(dao, files: list) -> None:
+        """
+        The original road insert, pushing every file through `to_postgis` in chunks of 1,000 rows.
+        Line strings are promoted to multi-part so they fit the roads_table geometry type.
+        """
+        from geoalchemy2 import Geometry
+        for file in files:
+            gdf = dao.frame_roads(file)
+            gdf = gdf.set_geometry(shapely.multilinestrings(gdf.geometry.to_numpy(), indices=np.arange(len(gdf))))
+            gdf.set_crs(3857, allow_override=True).to_postgis(
+                name="roads_table",
+                con=dao.engine,
+                if_exists="append",
+                chunksize=1000,
+                dtype={"geometry": Geometry("GEOMETRY", srid=3857)},
+            )
+
+    def bench_copy(self, files=None, connections=4) -> dict:
+        """
+        Loads road files into two throwaway schemas, once with the original chunked inserts and
+        once with the COPY bulk loader, checks that both hold the same rows and compares their
+        timings. Both schemas are dropped afterwards.
+
+        Parameters
+        ----------
+        files : list, optional
+            The road shapefiles to load. The default is the first 8 roads_*.zip in data/shape_files.
+        connections : int, optional
+            Number of parallel connections of the bulk loader. The default is 4.
+
+        Returns
+        -------
+        dict
+            The timings of both implementations and the speedup.
+        """
+        from src.data.data_db_dao import DAO
+        legacy = DAO(schema="bench_insert")
+        bulk = DAO(schema="bench_copy", connections=connections)
+        files = files or DAO.shape_files("roads")[:8]
+        try:
+            _, old_time = self.timed(self.legacy_roads, legacy, files)
+            _, new_time = self.timed(bulk.bulk_load, "roads_table", files, bulk.frame_roads)
+
+            totals = []
+            for dao in (legacy, bulk):
+                with dao.connection() as conn, conn.cursor() as cursor:
+                    cursor.execute("SELECT count(*), sum(ST_Length(geometry)) FROM roads_table;")
+                    totals.append(cursor.fetchone())
+            assert totals[0][0] == totals[1][0], "COPY bulk load differs from the chunked inserts"
+            assert np.isclose(totals[0][1], totals[1][1], rtol=1e-9), "COPY bulk load differs from the chunked inserts"
+        finally:
+            with legacy.connection() as conn, conn.cursor() as cursor:
+                cursor.execute("DROP SCHEMA IF EXISTS bench_insert CASCADE; DROP SCHEMA IF EXISTS bench_copy CASCADE;")
+            legacy.engine.dispose()
+            bulk.engine.dispose()
+
+        result = {"insert": old_time, "copy": new_time, "speedup": old_time / max(new_time, 1e-9)}
+        print("\033[0;32mBENCH: \033[0m" + f"Road load of {len(files)} files ({totals[1][0]} rows): "
+              f"insert {old_time:.2f}s, copy {new_time:.2f}s, {result['speedup']:.1f}x faster")
+        return result
+
+
+if __name__ == "__main__":
+    DataBench(debug=False).bench_length(6, 2019)
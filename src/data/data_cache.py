@@ -0,0 +1,200 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from src.data.data_store import DataStore
+import threading
+import tempfile
+import shutil
+import hashlib
+import json
+import os
+
+
+class DataCache:
+    """
+    A manifest of downloaded artifacts recording, for every local file, the URL it came
+    from, its size, SHA-256 digest, HTTP validators (ETag and Last-Modified) and fetch time.
+    Identical payloads are stored once and hard-linked to every path that references them.
+
+    Parameters
+    ----------
+    path : str, optional
+        Location of the JSON manifest. The default is "data/raw/manifest.json".
+    debug : bool, optional
+        If True, enables debug messages. The default is False.
+    """
+
+    def __init__(self, path="data/raw/manifest.json", debug=False):
+        """
+        Initializes the DataCache class and loads the manifest from disk.
+        """
+        self.path = path
+        self.debug = debug
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                self.entries = json.load(file)
+        self.by_hash = {entry["sha256"]: name for name, entry in self.entries.items()}
+
+    @staticmethod
+    def sha256(filename: str) -> str:
+        """
+        Computes the SHA-256 digest of a file.
+
+        Parameters
+        ----------
+        filename : str
+            The path of the file to hash.
+
+        Returns
+        -------
+        str
+            The hex digest of the file contents.
+        """
+        digest = hashlib.sha256()
+        with open(filename, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def get(self, filename: str) -> dict:
+        """
+        Returns the manifest entry for a file, or None if it was never recorded.
+        """
+        with self.lock:
+            return self.entries.get(filename)
+
+    def is_fresh(self, filename: str) -> bool:
+        """
+        Checks that a file is recorded and its size on disk still matches the manifest.
+
+        Parameters
+        ----------
+        filename : str
+            The path of the cached file.
+
+        Returns
+        -------
+        bool
+            True if the file can be used without contacting the server.
+        """
+        entry = self.get(filename)
+        return entry is not None and os.path.exists(filename) and os.path.getsize(filename) == entry["size"]
+
+    def record(self, filename: str, url: str, size: int, sha256: str, etag=None, last_modified=None) -> None:
+        """
+        Records a freshly downloaded file and replaces it with a hard link if an identical
+        payload is already cached under another path.
+
+        Parameters
+        ----------
+        filename : str
+            The path of the downloaded file.
+        url : str
+            The URL the file was downloaded from.
+        size : int
+            The size of the payload in bytes.
+        sha256 : str
+            The hex digest of the payload.
+        etag : str, optional
+            The ETag header returned by the server.
+        last_modified : str, optional
+            The Last-Modified header returned by the server.
+        """
+        with self.lock:
+            original = self.by_hash.get(sha256)
+            if original and original != filename and os.path.exists(original) and not os.path.samefile(original, filename):
+                self.link(original, filename)
+                if self.debug:
+                    print("\033[0;36mNOTICE: \033[0m" + f"Deduplicated {filename} against {original}")
+            self.entries[filename] = {
+                "url": url,
+                "size": size,
+                "sha256": sha256,
+                "etag": etag,
+                "last_modified": last_modified,
+                "fetched": datetime.now(timezone.utc).isoformat(),
+            }
+            self.by_hash.setdefault(sha256, filename)
+
+    def touch(self, filename: str) -> None:
+        """
+        Updates the fetch time of an entry the server confirmed as unchanged.
+        """
+        with self.lock:
+            self.entries[filename]["fetched"] = datetime.now(timezone.utc).isoformat()
+
+    def forget(self, filename: str) -> None:
+        """
+        Removes a file from the manifest so it is downloaded again on the next run.
+        """
+        with self.lock:
+            entry = self.entries.pop(filename, None)
+            if entry and self.by_hash.get(entry["sha256"]) == filename:
+                del self.by_hash[entry["sha256"]]
+
+    @staticmethod
+    def link(source: str, filename: str) -> None:
+        """
+        Atomically replaces `filename` with a hard link to `source`, or with a copy of it where
+        the file system cannot link them.
+        """
+        directory, name = os.path.split(filename)
+        # the link is made inside a private directory, so no other process can take its name
+        with tempfile.TemporaryDirectory(dir=directory or ".", prefix=f".{name}.", suffix=".link") as tmp:
+            staged = os.path.join(tmp, name)
+            try:
+                os.link(source, staged)
+            except OSError as error:
+                print("\033[1;33mWARNING: \033[0m" + f"Could not link {filename} to {source}, copying it: {error}")
+                shutil.copyfile(source, staged)
+            os.replace(staged, filename)
+
+    def save(self) -> None:
+        """
+        Writes the manifest to disk atomically.
+        """
+        with self.lock:
+            payload = json.dumps(self.entries, indent=2, sort_keys=True)
+        with DataStore.atomic_write(self.path) as tmp, open(tmp, "w") as file:
+            file.write(payload)
+
+    def verify(self, workers=8, remove=False) -> list:
+        """
+        Re-hashes every cached file in parallel and drops entries whose file is missing,
+        truncated or corrupt so that the next pull downloads them again.
+
+        Parameters
+        ----------
+        workers : int, optional
+            Number of files hashed concurrently. The default is 8.
+        remove : bool, optional
+            If True, also deletes the corrupt files from disk. The default is False.
+
+        Returns
+        -------
+        list
+            The paths of the files that failed verification.
+        """
+        def check(item: tuple) -> bool:
+            filename, entry = item
+            if not os.path.exists(filename) or os.path.getsize(filename) != entry["size"]:
+                return False
+            return self.sha256(filename) == entry["sha256"]
+
+        with self.lock:
+            items = list(self.entries.items())
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(check, items))
+
+        bad = [filename for (filename, _), ok in zip(items, results) if not ok]
+        for filename in bad:
+            self.forget(filename)
+            if remove and os.path.exists(filename):
+                os.remove(filename)
+            if self.debug:
+                print("\033[1;33mWARNING: \033[0m" + f"Cached file {filename} failed verification")
+        self.save()
+        if self.debug:
+            print("\033[0;32mINFO: \033[0m" + f"Verified {len(items)} cached files, {len(bad)} failed")
+        return bad
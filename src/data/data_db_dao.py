@@ -1,193 +1,378 @@
+from concurrent.futures import ThreadPoolExecutor
 from src.data.data_process import DataProcess
-from sqlalchemy import create_engine, text
-from geoalchemy2 import Geometry
+from sqlalchemy import create_engine, event
+from contextlib import contextmanager
 from dotenv import load_dotenv
 import geopandas as gpd
 import pandas as pd
-import psycopg2
+import shapely
+import io
 import os
 
 load_dotenv()
 
 
 class DAO(DataProcess):
-    def __init__(self):
-        super().__init__()
+    """
+    Loads the shapefiles and processed data into PostGIS.
+
+    Every query runs on a connection checked out of one shared pool. Files are bulk loaded
+    with `COPY ... FROM STDIN` into temporary staging tables over parallel connections, one transaction per file, and recorded in a load
+    ledger with their SHA-256 digest and row count, so interrupted loads resume where they
+    stopped. The spatial and B-tree indexes of the target table are built after the load.
+
+    Parameters
+    ----------
+    debug : bool, optional
+        If True, enables debug messages. The default is False.
+    schema : str, optional
+        The schema the tables are created in, e.g. a throwaway schema for testing. The default is "public".
+    connections : int, optional
+        Number of files loaded in parallel. The default is 4.
+    pool_size : int, optional
+        Number of connections kept in the shared pool. Loaders and readers check connections
+        out of it and wait when all are in use. The default is `connections` + 1.
+    max_overflow : int, optional
+        Number of connections opened beyond `pool_size` under load. The default is 0.
+    statement_timeout : int, optional
+        The statement timeout in milliseconds of pooled connections. Bulk loads and index builds
+        lift it for their own transactions. The default is 30,000.
+    """
+
+    # indexes built after a bulk load, by table
+    indexes = {
+        "states_shp": {"states_shp_geometry_idx": "USING gist (geometry)"},
+        "blocks_shp": {"blocks_shp_geometry_idx": "USING gist (geometry)",
+                       "blocks_shp_state_id_idx": "(state_id)"},
+        "pumas_shp": {"pumas_shp_geometry_idx": "USING gist (geometry)",
+                      "pumas_shp_state_id_idx": "(state_id)"},
+        "roads_table": {"roads_table_geometry_idx": "USING gist (geometry)",
+                        "roads_table_linear_id_idx": "(linear_id, year)"},
+    }
+
+    # statements prepared on every pooled connection, executed with EXECUTE name (...)
+    statements = {
+        "ledger_lookup": "PREPARE ledger_lookup (text) AS "
+                         "SELECT source, sha256 FROM load_ledger WHERE table_name = $1 AND status = 'loaded';",
+        "ledger_record": "PREPARE ledger_record (text, text, text, bigint, text) AS "
+                         "INSERT INTO load_ledger (table_name, source, sha256, rows, status) "
+                         "VALUES ($1, $2, $3, $4, $5) ON CONFLICT (table_name, source) DO UPDATE SET "
+                         "sha256 = EXCLUDED.sha256, rows = EXCLUDED.rows, status = EXCLUDED.status, loaded_at = now();",
+    }
+
+    def __init__(self, debug=False, schema="public", connections=4, pool_size=None, max_overflow=0,
+                 statement_timeout=30_000, **kwargs):
+        super().__init__(debug=debug, **kwargs)
+        self.schema = schema
+        self.connections = connections
         db_user = os.environ.get("POSTGRES_USER")
         db_password = os.environ.get("POSTGRES_PASSWORD")
         db_name = os.environ.get("POSTGRES_DB")
         db_host = os.environ.get("POSTGRES_HOST")
         db_port = os.environ.get("POSTGRES_PORT")
-        self.conn2 = create_engine(
-            f"postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
-        )
-        self.conn = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            port=db_port,
+        self.engine = create_engine(
+            f"postgresql+psycopg2://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}",
+            pool_size=pool_size or connections + 1,
+            max_overflow=max_overflow,
+            pool_timeout=None,
+            pool_pre_ping=True,
+            connect_args={"options": f"-c search_path={schema},public -c statement_timeout={statement_timeout}"},
         )
         with open("src/data/schema.sql", "r") as file:
             sql_query = file.read()
-        cursor = self.conn.cursor()
-        cursor.execute(sql_query)
-        self.conn.commit()
-        self.insert_states()
-        self.insert_pumas()
-        self.insert_blocks()
-        self.insert_roads()
-        self.insert_acs()
-
-    def data_exists(self, table_name):
-        with self.conn2.connect() as con:
-            result = con.execute(
-                text(f"SELECT EXISTS (SELECT 1 FROM {table_name} LIMIT 1);")
-            )
-            return result.scalar()
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(f'CREATE SCHEMA IF NOT EXISTS "{schema}";')
+            cursor.execute(sql_query)
+        # connections opened from now on prepare the statements once, when they are created
+        self.engine.dispose()
+        event.listen(self.engine, "connect", self.prepare)
+
+    @classmethod
+    def prepare(cls, dbapi_connection, connection_record) -> None:
+        """
+        Prepares the frequently executed statements on a new pooled connection.
+        """
+        with dbapi_connection.cursor() as cursor:
+            for statement in cls.statements.values():
+                cursor.execute(statement)
+        dbapi_connection.commit()
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks a connection out of the pool for one transaction, which is committed if the
+        block succeeds and rolled back otherwise, and returns it to the pool.
+
+        Yields
+        ------
+        psycopg2.extensions.connection
+            The DBAPI connection, with the DAO schema first on the search path.
+        """
+        conn = self.engine.raw_connection()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    @staticmethod
+    def copy_frame(cursor, table: str, gdf: pd.DataFrame, chunk_size=100_000) -> int:
+        """
+        Streams a (Geo)DataFrame into a table with `COPY ... FROM STDIN` in CSV format. The
+        geometries are sent as hex EWKB with SRID 3857.
+
+        Parameters
+        ----------
+        cursor : psycopg2.extensions.cursor
+            The cursor of the loading connection.
+        table : str
+            The table to copy into.
+        gdf : pd.DataFrame
+            The rows to copy, with the columns named as in the table.
+        chunk_size : int, optional
+            Number of rows serialized per COPY statement. The default is 100,000.
+
+        Returns
+        -------
+        int
+            The number of rows copied.
+        """
+        columns = ", ".join(f'"{column}"' for column in gdf.columns)
+        geometry = gdf.geometry.name if isinstance(gdf, gpd.GeoDataFrame) else None
+        for start in range(0, len(gdf), chunk_size):
+            chunk = pd.DataFrame(gdf.iloc[start:start + chunk_size])
+            if geometry is not None:
+                geoms = shapely.set_srid(chunk[geometry].to_numpy(), 3857)
+                chunk[geometry] = shapely.to_wkb(geoms, hex=True, include_srid=True)
+            buffer = io.StringIO()
+            chunk.to_csv(buffer, index=False, header=False)
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+        return len(gdf)
+
+    def digest(self, file: str) -> str:
+        """
+        Returns the SHA-256 digest of a file, taken from the download manifest when the file
+        is unchanged since it was downloaded.
+        """
+        entry = self.cache.get(file)
+        if entry is not None and self.cache.is_fresh(file):
+            return entry["sha256"]
+        return self.cache.sha256(file)
+
+    def ledger(self, table: str) -> dict:
+        """
+        Returns the files recorded as loaded into a table in the load ledger.
+
+        Parameters
+        ----------
+        table : str
+            The target table.
+
+        Returns
+        -------
+        dict
+            The SHA-256 digest of every loaded file, by file name.
+        """
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("EXECUTE ledger_lookup (%s);", (table,))
+            return dict(cursor.fetchall())
+
+    @staticmethod
+    def record(cursor, table: str, source: str, sha256: str, rows: int, status: str) -> None:
+        """
+        Records the outcome of loading a file in the load ledger.
+        """
+        cursor.execute("EXECUTE ledger_record (%s, %s, %s, %s, %s);", (table, source, sha256, rows, status))
+
+    def bulk_load(self, table: str, files: list, frame, order=None) -> int:
+        """
+        Bulk loads files into a table, resuming from the load ledger. Files already recorded
+        as loaded with the same SHA-256 digest are skipped. Every other file is loaded in its
+        own transaction over a pool of parallel connections: it is copied into a temporary
+        (unlogged) staging table, moved into the target table with geometries promoted to
+        multi-part, and recorded in the ledger, so an interrupted load restarts at the first
+        file that did not commit. The indexes of the target table are dropped while files are
+        loaded and built afterwards.
+
+        Parameters
+        ----------
+        table : str
+            The target table.
+        files : list
+            The files to load.
+        frame : callable
+            Reads a file and returns a (Geo)DataFrame with the columns named as in the table.
+        order : str, optional
+            A column the rows of a file are inserted in, so sequential ids follow it. The default is None.
+
+        Returns
+        -------
+        int
+            The number of rows loaded.
+        """
+        loaded = self.ledger(table)
+        pending = []
+        for file in files:
+            source = os.path.basename(file)
+            sha256 = self.digest(file)
+            if source not in loaded:
+                pending.append((file, sha256))
+            elif loaded[source] != sha256:
+                print("\033[1;33mWARNING: \033[0m" + f"{source} changed since it was loaded into {table}, "
+                      "reload the table to pick up the change")
+        if self.debug:
+            print("\033[0;36mPROCESS: \033[0m" + f"{len(files) - len(pending)} of {len(files)} files "
+                  f"already loaded into {table}")
+        if not pending:
+            self.build_indexes(table)
+            return 0
+
+        with self.connection() as conn, conn.cursor() as cursor:
+            for name in self.indexes.get(table, {}):
+                cursor.execute(f'DROP INDEX IF EXISTS "{name}";')
+
+        def load(item: tuple) -> int:
+            file, sha256 = item
+            source = os.path.basename(file)
+            try:
+                df = frame(file)
+                columns = [f'"{column}"' for column in df.columns]
+                select = ["ST_Multi(geometry)" if column == '"geometry"' else column for column in columns]
+                sort = f' ORDER BY "{order}"' if order else ""
+                with self.connection() as conn, conn.cursor() as cur:
+                    cur.execute("SET LOCAL statement_timeout = 0;")
+                    cur.execute(f"CREATE TEMP TABLE staging ON COMMIT DROP AS "
+                                f"SELECT {', '.join(columns)} FROM {table} WITH NO DATA;")
+                    if "geometry" in df.columns:
+                        cur.execute("ALTER TABLE staging ALTER COLUMN geometry TYPE geometry(Geometry, 3857);")
+                    rows = self.copy_frame(cur, "staging", df)
+                    cur.execute(f"INSERT INTO {table} ({', '.join(columns)}) "
+                                f"SELECT {', '.join(select)} FROM staging{sort};")
+                    self.record(cur, table, source, sha256, rows, "loaded")
+            except Exception as error:
+                with self.connection() as conn, conn.cursor() as cur:
+                    self.record(cur, table, source, sha256, 0, "failed")
+                print("\033[1;33mWARNING: \033[0m" + f"Failed to load {source} into {table}: {error}")
+                return None
+            if self.debug:
+                print("\033[0;36mPROCESS: \033[0m" + f"Loaded {rows} rows from {source} into {table}")
+            return rows
+
+        with ThreadPoolExecutor(max_workers=min(self.connections, len(pending))) as executor:
+            results = list(executor.map(load, pending))
+
+        self.build_indexes(table)
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("SET LOCAL statement_timeout = 0;")
+            cursor.execute(f"ANALYZE {table};")
+        failed = [os.path.basename(file) for (file, _), rows in zip(pending, results) if rows is None]
+        if failed:
+            raise RuntimeError(f"{len(failed)} files failed to load into {table}: {', '.join(failed[:10])}")
+        return sum(results)
+
+    def build_indexes(self, table: str) -> None:
+        """
+        Creates the spatial and B-tree indexes of a table that are missing.
+        """
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("SET LOCAL statement_timeout = 0;")
+            cursor.execute("SET LOCAL maintenance_work_mem = '512MB';")
+            for name, definition in self.indexes.get(table, {}).items():
+                cursor.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON {table} {definition};')
+
+    @staticmethod
+    def shape_files(prefix: str) -> list:
+        """
+        Lists the zipped shapefiles in data/shape_files starting with `prefix`.
+        """
+        return sorted(
+            f"data/shape_files/{file}" for file in os.listdir("data/shape_files/")
+            if file.endswith(".zip") and file.startswith(prefix)
+        )
+
+    @staticmethod
+    def frame_states(file: str) -> gpd.GeoDataFrame:
+        gdf = gpd.read_file(file, engine="pyogrio")
+        gdf.rename(
+            columns={
+                "STATEFP": "state_id",
+                "STUSPS": "state_abbr",
+                "NAME": "state_name",
+            },
+            inplace=True,
+        )
+        return gdf[["state_id", "state_abbr", "state_name", "geometry"]].astype({"state_id": "int64"})
+
+    @staticmethod
+    def frame_blocks(file: str) -> gpd.GeoDataFrame:
+        gdf = gpd.read_file(file, engine="pyogrio")
+        gdf.rename(
+            columns={"STATEFP20": "state_id", "GEOID20": "block_num"},
+            inplace=True,
+        )
+        return gdf[["state_id", "block_num", "geometry"]].astype({"state_id": "int64"})
+
+    @staticmethod
+    def frame_pumas(file: str) -> gpd.GeoDataFrame:
+        gdf = gpd.read_file(file, engine="pyogrio")
+        gdf.rename(
+            columns={
+                "STATEFP10": "state_id",
+                "GEOID10": "puma_num",
+                "NAMELSAD10": "puma_name",
+            },
+            inplace=True,
+        )
+        return gdf[["state_id", "puma_num", "puma_name", "geometry"]].astype({"state_id": "int64"})
+
+    @staticmethod
+    def frame_roads(file: str) -> gpd.GeoDataFrame:
+        year = os.path.basename(file).split("_")[1]
+        gdf = gpd.read_file(file, engine="pyogrio", columns=["LINEARID"])
+        gdf.rename(columns={"LINEARID": "linear_id"}, inplace=True)
+        gdf["year"] = pd.to_datetime(year, format="%Y")
+        return gdf[["linear_id", "year", "geometry"]]
+
+    @staticmethod
+    def frame_acs(file: str) -> pd.DataFrame:
+        df = pd.read_parquet(file, columns=["year", "state", "PUMA", "avg_time", "sex", "race"])
+        df.rename(
+            columns={
+                "state": "state_id",
+                "PUMA": "puma_id",
+                "race": "race_id",
+                "sex": "sex_id",
+            },
+            inplace=True,
+        )
+        df["year"] = pd.to_datetime(df["year"].astype(str), format="%Y")
+        return df
 
     def insert_states(self):
-        if not self.data_exists("states_shp"):
-            gdf = gpd.read_file("data/shape_files/states.zip", engine="pyogrio")
-            gdf.rename(
-                columns={
-                    "STATEFP": "state_id",
-                    "STUSPS": "state_abbr",
-                    "NAME": "state_name",
-                },
-                inplace=True,
-            )
-            gdf = (
-                gdf[["state_id", "state_abbr", "state_name", "geometry"]]
-                .astype({"state_id": "int64"})
-                .set_crs(3857, allow_override=True)
-            )
-            gdf.to_postgis(
-                name="states_shp",
-                con=self.conn2,
-                if_exists="append",
-                chunksize=5000,
-                dtype={"geometry": Geometry("GEOMETRY", srid=3857)},
-            )
-            print("\033[0;36mPROCESS: \033[0m" + "Finished inserting states")
-        else:
-            print("\033[0;36mPROCESS: \033[0m" + "States data already exists")
+        self.bulk_load("states_shp", ["data/shape_files/states.zip"], self.frame_states)
+        print("\033[0;36mPROCESS: \033[0m" + "Finished inserting states")
 
     def insert_blocks(self):
-        if not self.data_exists("blocks_shp"):
-            id_count = 0
-            for file in os.listdir("data/shape_files/"):
-                if file.endswith(".zip") and file.startswith("block_"):
-                    gdf = gpd.read_file(f"data/shape_files/{file}", engine="pyogrio")
-                    gdf.rename(
-                        columns={"STATEFP20": "state_id", "GEOID20": "block_num"},
-                        inplace=True,
-                    )
-                    gdf["block_id"] = gdf.index.values + 1 + id_count
-                    gdf = (
-                        gdf.astype({"state_id": "int64"})
-                        .set_crs(3857, allow_override=True)
-                        .sort_values(by="block_num")
-                        .reset_index(drop=True)
-                    )
-                    gdf = gdf[["block_id", "state_id", "block_num", "geometry"]]
-                    gdf.to_postgis(
-                        name="blocks_shp",
-                        con=self.conn2,
-                        if_exists="append",
-                        chunksize=5000,
-                        dtype={"geometry": Geometry("GEOMETRY", srid=3857)},
-                    )
-                    id_count += len(gdf)
-                    print(
-                        "\033[0;36mPROCESS: \033[0m"
-                        + f"Finished inserting {file} blocks"
-                    )
-        else:
-            print("\033[0;36mPROCESS: \033[0m" + "Blocks data already exists")
+        rows = self.bulk_load("blocks_shp", self.shape_files("block_"), self.frame_blocks, order="block_num")
+        print("\033[0;36mPROCESS: \033[0m" + f"Finished inserting {rows} blocks")
 
     def insert_pumas(self):
-        if not self.data_exists("pumas_shp"):
-            id_count = 0
-            for file in os.listdir("data/shape_files/"):
-                if file.endswith(".zip") and file.startswith("puma_"):
-                    gdf = gpd.read_file(f"data/shape_files/{file}", engine="pyogrio")
-                    gdf.rename(
-                        columns={
-                            "STATEFP10": "state_id",
-                            "GEOID10": "puma_num",
-                            "NAMELSAD10": "puma_name",
-                        },
-                        inplace=True,
-                    )
-                    gdf = (
-                        gdf.astype({"state_id": "int64"})
-                        .set_crs(3857, allow_override=True)
-                        .sort_values(by="puma_num")
-                        .reset_index(drop=True)
-                    )
-                    gdf["puma_id"] = gdf.index.values + 1 + id_count
-                    gdf = gdf[
-                        ["puma_id", "state_id", "puma_num", "puma_name", "geometry"]
-                    ]
-                    gdf.to_postgis(
-                        name="pumas_shp",
-                        con=self.conn2,
-                        if_exists="append",
-                        chunksize=5000,
-                        dtype={"geometry": Geometry("GEOMETRY", srid=3857)},
-                    )
-                    id_count += len(gdf)
-                    print(
-                        "\033[0;36mPROCESS: \033[0m"
-                        + f"Finished inserting {file} pumas"
-                    )
-        else:
-            print("\033[1;33mWARNING: \033[0m" + "Pumas data already exists")
+        rows = self.bulk_load("pumas_shp", self.shape_files("puma_"), self.frame_pumas, order="puma_num")
+        print("\033[0;36mPROCESS: \033[0m" + f"Finished inserting {rows} pumas")
 
     def insert_roads(self):
-        if not self.data_exists("roads_table"):
-            for file in os.listdir("data/shape_files/"):
-                if file.startswith("roads"):
-                    year = file.split("_")[1]
-                    gdf = gpd.read_file(f"data/shape_files/{file}", engine="pyogrio")
-                    gdf.rename(columns={"LINEARID": "linear_id"}, inplace=True)
-                    gdf["year"] = pd.to_datetime(year, format="%Y")
-                    gdf = gdf[["linear_id", "year", "geometry"]].set_crs(
-                        3857, allow_override=True
-                    )
-                    gdf.to_postgis(
-                        name="roads_table",
-                        con=self.conn2,
-                        if_exists="append",
-                        chunksize=1000,
-                        dtype={"geometry": Geometry("GEOMETRY", srid=3857)},
-                    )
-                    print(
-                        "\033[0;36mPROCESS: \033[0m"
-                        + f"Finished inserting {file} roads"
-                    )
-
-        else:
-            print("\033[0;36mPROCESS: \033[0m" + "Roads data already exists")
+        rows = self.bulk_load("roads_table", self.shape_files("roads"), self.frame_roads)
+        print("\033[0;36mPROCESS: \033[0m" + f"Finished inserting {rows} roads")
 
     def insert_acs(self):
-        if not self.data_exists("acs_table"):
-            df = self.process_acs()
-            df = df.rename(
-                {
-                    "state": "state_id",
-                    "PUMA": "puma_id",
-                    "race": "race_id",
-                    "sex": "sex_id",
-                }
-            )
-            df.write_database(
-                table_name="acs_table",
-                connection=self.conn2,
-                if_table_exists="append",
-            )
+        rows = self.bulk_load("acs_table", ["data/processed/acs.parquet"], self.frame_acs)
+        print("\033[0;36mPROCESS: \033[0m" + f"Finished inserting {rows} ACS rows")
 
 
 if __name__ == "__main__":
-    DAO()
+    from src.data.data_pipeline import DataPipeline
+    DataPipeline(debug=True, database=True).run()
@@ -0,0 +1,350 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError, RequestException
+import threading
+import hashlib
+import tempfile
+import requests
+import time
+import os
+
+
+class RateLimit:
+    """
+    A thread-safe limiter that spaces calls evenly to at most `rate` per second.
+
+    Parameters
+    ----------
+    rate : float
+        Maximum number of calls per second. Zero or None disables the limit.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self) -> None:
+        """
+        Blocks until the caller may issue its next request.
+        """
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class DataDownload:
+    """
+    A concurrent downloader that reuses pooled keep-alive connections, retries
+    failed transfers with exponential backoff and writes every file atomically.
+
+    Parameters
+    ----------
+    workers : int, optional
+        Number of concurrent downloads. The default is 16.
+    retries : int, optional
+        Number of retries per file before giving up. The default is 5.
+    backoff : float, optional
+        Base delay in seconds for the exponential backoff. The default is 0.5.
+    timeout : float, optional
+        Connect and read timeout in seconds. The default is 60.
+    rate : float, optional
+        Maximum number of requests per second across all workers. The default is None (unlimited).
+    cache : DataCache, optional
+        Manifest used to validate, revalidate and deduplicate downloads. If None, a file
+        counts as downloaded as soon as it exists. The default is None.
+    debug : bool, optional
+        If True, enables debug messages. The default is False.
+    """
+
+    def __init__(self, workers=16, retries=5, backoff=0.5, timeout=60, rate=None, cache=None, debug=False):
+        """
+        Initializes the DataDownload class and its pooled HTTP session.
+        """
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.debug = debug
+        self.limit = RateLimit(rate)
+        self.cache = cache
+        self.session = self.make_session(workers)
+
+    @staticmethod
+    def make_session(pool_size: int) -> requests.Session:
+        """
+        Creates a requests session whose connection pool fits `pool_size` concurrent requests.
+
+        Parameters
+        ----------
+        pool_size : int
+            Maximum number of keep-alive connections per host.
+
+        Returns
+        -------
+        requests.Session
+            A session with pooled HTTP and HTTPS adapters.
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    @staticmethod
+    def unavailable(error: RequestException) -> bool:
+        """
+        Checks whether a request failed because the server does not have the file, e.g. a
+        404 for a county that did not exist yet in a TIGER year. Retrying will not help.
+        """
+        status = error.response.status_code if isinstance(error, HTTPError) and error.response is not None else None
+        return status is not None and 400 <= status < 500 and status != 429
+
+    def retryable(self, error: RequestException, attempt: int) -> bool:
+        """
+        Decides whether a failed request should be retried and sleeps for the backoff if so.
+
+        Parameters
+        ----------
+        error : RequestException
+            The exception raised by the failed request.
+        attempt : int
+            The zero-based attempt number that failed.
+
+        Returns
+        -------
+        bool
+            True if the request should be tried again.
+        """
+        if attempt == self.retries or self.unavailable(error):
+            return False
+        time.sleep(self.backoff * 2 ** attempt)
+        return True
+
+    def get_json(self, url: str):
+        """
+        Requests a JSON document through the pooled session, honoring the rate limit and retries.
+
+        Parameters
+        ----------
+        url : str
+            The URL to request.
+
+        Returns
+        -------
+        object
+            The decoded JSON payload.
+
+        Raises
+        ------
+        RequestException
+            If the request failed after all retries.
+        """
+        for attempt in range(self.retries + 1):
+            self.limit.wait()
+            try:
+                r = self.session.get(url, timeout=self.timeout)
+                r.raise_for_status()
+                return r.json() if r.status_code != 204 else []
+            except RequestException as e:
+                if not self.retryable(e, attempt):
+                    raise
+
+    def fetch(self, url: str, filename: str, conditional=False) -> int:
+        """
+        Downloads a single URL to a temporary file next to `filename` and renames
+        it into place once the transfer is complete.
+
+        Parameters
+        ----------
+        url : str
+            The URL of the file to download.
+        filename : str
+            The path to save the downloaded file.
+        conditional : bool, optional
+            If True, sends the cached validators so the server can answer 304 Not Modified.
+            The default is False.
+
+        Returns
+        -------
+        int
+            The number of bytes written, or 0 if the cached copy is still current.
+
+        Raises
+        ------
+        RequestException
+            If the file could not be downloaded after all retries.
+        """
+        headers = {}
+        entry = self.cache.get(filename) if self.cache and conditional else None
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        directory, name = os.path.split(filename)
+        for attempt in range(self.retries + 1):
+            self.limit.wait()
+            fd, tmp = tempfile.mkstemp(dir=directory or ".", prefix=f".{name}.", suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as file, self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+                    r.raise_for_status()
+                    if r.status_code == 304:
+                        os.remove(tmp)
+                        self.cache.touch(filename)
+                        return 0
+                    digest = hashlib.sha256()
+                    size = 0
+                    for chunk in r.iter_content(chunk_size=1 << 20):
+                        file.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                    length = r.headers.get("Content-Length")
+                    if length is not None and "Content-Encoding" not in r.headers and int(length) != size:
+                        raise RequestException(f"Incomplete transfer: {size} of {length} bytes")
+                os.chmod(tmp, 0o644)
+                os.replace(tmp, filename)
+                if self.cache:
+                    self.cache.record(filename, url, size, digest.hexdigest(),
+                                      r.headers.get("ETag"), r.headers.get("Last-Modified"))
+                return size
+            except RequestException as e:
+                os.remove(tmp)
+                if not self.retryable(e, attempt):
+                    raise
+            except BaseException:
+                os.remove(tmp)
+                raise
+
+    def adopt(self, url: str, filename: str) -> bool:
+        """
+        Records a file that predates the manifest if a HEAD request confirms its size,
+        avoiding a full transfer.
+
+        Parameters
+        ----------
+        url : str
+            The URL the file was downloaded from.
+        filename : str
+            The path of the existing file.
+
+        Returns
+        -------
+        bool
+            True if the file was recorded, False if it must be downloaded again.
+        """
+        self.limit.wait()
+        try:
+            r = self.session.head(url, timeout=self.timeout, allow_redirects=True)
+            r.raise_for_status()
+        except RequestException:
+            return False
+        length = r.headers.get("Content-Length")
+        size = os.path.getsize(filename)
+        if length is None or int(length) != size:
+            return False
+        self.cache.record(filename, url, size, self.cache.sha256(filename),
+                          r.headers.get("ETag"), r.headers.get("Last-Modified"))
+        return True
+
+    def sync(self, url: str, filename: str, revalidate=False) -> int:
+        """
+        Brings one cached file up to date, using the cheapest request that is sufficient.
+
+        Parameters
+        ----------
+        url : str
+            The URL of the file.
+        filename : str
+            The local path of the file.
+        revalidate : bool, optional
+            If True, files already in the manifest are revalidated with a conditional GET.
+            The default is False.
+
+        Returns
+        -------
+        int
+            The number of bytes transferred.
+        """
+        if self.cache and self.cache.is_fresh(filename):
+            return self.fetch(url, filename, conditional=True) if revalidate else 0
+        if self.cache and self.cache.get(filename) is None and os.path.exists(filename):
+            if self.adopt(url, filename):
+                return 0
+        return self.fetch(url, filename)
+
+    def pending(self, filename: str, revalidate=False) -> bool:
+        """
+        Checks whether a file needs any network round-trip at all.
+        """
+        if self.cache is None:
+            return not os.path.exists(filename)
+        return revalidate or not self.cache.is_fresh(filename)
+
+    def fetch_all(self, jobs: list, revalidate=False) -> dict:
+        """
+        Downloads every (url, filename) pair that is not already cached using a
+        bounded pool of workers and reports the achieved throughput.
+
+        Parameters
+        ----------
+        jobs : list
+            A list of (url, filename) tuples.
+        revalidate : bool, optional
+            If True, cached files are revalidated against the server. The default is False.
+
+        Returns
+        -------
+        dict
+            Counts of downloaded, unchanged, skipped, unavailable (4xx) and failed files, total
+            bytes and elapsed seconds. Only transient or network errors that outlasted the
+            retries count as failed.
+        """
+        stats = {"downloaded": 0, "unchanged": 0, "skipped": 0, "unavailable": 0, "failed": 0,
+                 "bytes": 0, "seconds": 0.0}
+        pending = []
+        for url, filename in jobs:
+            if self.pending(filename, revalidate):
+                pending.append((url, filename))
+            else:
+                stats["skipped"] += 1
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.sync, url, filename, revalidate): filename for url, filename in pending}
+            for done, future in enumerate(as_completed(futures), start=1):
+                filename = futures[future]
+                try:
+                    size = future.result()
+                    stats["bytes"] += size
+                    stats["downloaded" if size else "unchanged"] += 1
+                    if self.debug and size:
+                        print("\033[0;32mINFO: \033[0m" + f"Downloaded {filename}")
+                except RequestException as e:
+                    if self.unavailable(e):
+                        stats["unavailable"] += 1
+                        if self.debug:
+                            print("\033[0;36mNOTICE: \033[0m" + f"{filename} is not available: {e}")
+                    else:
+                        stats["failed"] += 1
+                        if self.debug:
+                            print("\033[1;33mWARNING: \033[0m" + f"Could not download {filename}: {e}")
+                if self.cache and done % 500 == 0:
+                    self.cache.save()
+        stats["seconds"] = time.perf_counter() - start
+        if self.cache and pending:
+            self.cache.save()
+
+        if self.debug and pending:
+            elapsed = max(stats["seconds"], 1e-9)
+            print("\033[0;32mINFO: \033[0m" + f"Downloaded {stats['downloaded']} files "
+                  f"({stats['unchanged']} unchanged, {stats['unavailable']} unavailable, {stats['failed']} failed, "
+                  f"{stats['skipped']} skipped) in {elapsed:.1f}s: {stats['downloaded'] / elapsed:.2f} files/s, "
+                  f"{stats['bytes'] / elapsed / 1e6:.2f} MB/s")
+        return stats
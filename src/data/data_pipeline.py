@@ -0,0 +1,297 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from src.data.data_process import DataProcess
+from src.data.data_store import DataStore
+import threading
+import hashlib
+import inspect
+import json
+import glob
+import os
+
+
+class Stage:
+    """
+    A single step of the pipeline together with the files it reads and writes.
+
+    Parameters
+    ----------
+    name : str
+        Unique name of the stage.
+    run : callable
+        Function executed to (re)build the stage outputs.
+    inputs : list, optional
+        Glob patterns of the files the stage reads. The default is an empty list.
+    outputs : list, optional
+        Glob patterns of the files the stage writes. The default is an empty list.
+    after : list, optional
+        Names of stages that must finish first. The default is an empty list.
+    clean : bool, optional
+        If True, existing outputs are removed before a stale stage is rebuilt. This is
+        needed for stages that treat an existing output as "already done". Outputs are kept
+        when the previous attempt with the same inputs was interrupted, so stages that skip
+        finished work can resume. The default is False.
+    """
+
+    def __init__(self, name, run, inputs=(), outputs=(), after=(), clean=False):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.after = list(after)
+        self.clean = clean
+
+    def input_key(self) -> str:
+        """
+        Fingerprints the stage inputs together with the source code of the stage function.
+        """
+        try:
+            source = inspect.getsource(self.run)
+        except (OSError, TypeError):
+            source = self.name
+        return hashlib.sha256((source + DataStore.fingerprint(self.inputs)).encode()).hexdigest()
+
+    def remove_outputs(self) -> None:
+        """
+        Removes every file matching the stage outputs, and the directories below the fixed
+        part of each pattern that are left empty, e.g. the hive partitions of the roads.
+        """
+        for pattern in self.outputs:
+            root = os.path.dirname(pattern.split("*", 1)[0].split("?", 1)[0].split("[", 1)[0])
+            for path in glob.glob(pattern, recursive=True):
+                if os.path.isfile(path):
+                    os.remove(path)
+                    parent = os.path.dirname(path)
+                    while root and parent.startswith(root + os.sep) and not os.listdir(parent):
+                        os.rmdir(parent)
+                        parent = os.path.dirname(parent)
+
+
+class DataPipeline:
+    """
+    A dependency-aware, incremental runner for the data pipeline. Every stage records a
+    fingerprint of its inputs and outputs, and only stages whose fingerprints changed are
+    rebuilt. Independent stages run in parallel.
+
+    Parameters
+    ----------
+    debug : bool, optional
+        If True, enables debug messages. The default is False.
+    database : bool, optional
+        If True, adds the PostGIS insert stages. The default is False.
+    max_stages : int, optional
+        Maximum number of stages running at the same time. The default is 4.
+    state_file : str, optional
+        Location of the recorded fingerprints. The default is "data/interim/pipeline.json".
+    **kwargs
+        Passed on to `DataProcess` (or `DAO`), e.g. `workers` for the download pool or
+        `jobs` for the road length process pool.
+    """
+
+    def __init__(self, debug=False, database=False, max_stages=4, state_file="data/interim/pipeline.json", **kwargs):
+        """
+        Initializes the DataPipeline class and declares its stages.
+        """
+        self.debug = debug
+        self.max_stages = max_stages
+        self.state_file = state_file
+        if database:
+            from src.data.data_db_dao import DAO
+            self.data = DAO(debug=debug, **kwargs)
+        else:
+            self.data = DataProcess(debug=debug, **kwargs)
+        self.stages = {stage.name: stage for stage in self.declare(database)}
+        self.lock = threading.Lock()
+        self.state = {}
+        if os.path.exists(state_file):
+            with open(state_file, "r") as file:
+                self.state = json.load(file)
+
+    def declare(self, database: bool) -> list:
+        """
+        Declares the pipeline stages and the files they read and write.
+
+        Parameters
+        ----------
+        database : bool
+            If True, includes the PostGIS insert stages.
+
+        Returns
+        -------
+        list
+            The list of stages.
+        """
+        d = self.data
+        stages = [
+            Stage("pull_movs", d.pull_movs, outputs=["data/raw/movs.csv"]),
+            Stage("pull_state_codes", d.pull_state_codes, inputs=["data/raw/movs.csv"],
+                  outputs=["data/external/state_codes.parquet"], clean=True),
+            Stage("pull_counties", d.pull_counties, outputs=["data/shape_files/counties.zip"]),
+            Stage("pull_county_codes", d.pull_county_codes,
+                  inputs=["data/shape_files/counties.zip", "data/external/state_codes.parquet"],
+                  outputs=["data/external/county_codes.parquet"], clean=True),
+            Stage("pull_states", d.pull_states, outputs=["data/shape_files/states.zip"]),
+            Stage("pull_pumas", d.pull_pumas, inputs=["data/external/state_codes.parquet"],
+                  outputs=["data/shape_files/puma_*.zip"]),
+            Stage("pull_roads", d.pull_roads, inputs=["data/external/county_codes.parquet"],
+                  outputs=["data/shape_files/roads_*.zip"]),
+            Stage("pull_cpi", d.pull_cpi, outputs=["data/external/cpi.parquet"]),
+            Stage("pull_acs", d.pull_acs, inputs=["data/external/state_codes.parquet"],
+                  outputs=["data/raw/acs_*.parquet"]),
+            Stage("process_states", d.process_states, inputs=["data/shape_files/states.zip"],
+                  outputs=["data/interim/states.parquet"], clean=True),
+            Stage("process_county", d.process_county, inputs=["data/shape_files/counties.zip"],
+                  outputs=["data/interim/counties.parquet"], clean=True),
+            Stage("process_pumas", d.process_pumas, inputs=["data/shape_files/puma_*.zip"],
+                  outputs=["data/interim/pumas.parquet"], clean=True),
+            Stage("process_geojson", d.process_geojson, inputs=["data/interim/pumas.parquet"],
+                  outputs=["data/processed/geojson/*.json"], clean=True),
+            Stage("process_weights", d.process_weights, inputs=["data/interim/pumas.parquet"],
+                  outputs=["data/processed/weights/*.npz"]),
+            Stage("process_acs", d.process_acs, inputs=["data/raw/acs_*.parquet", "data/external/cpi.parquet"],
+                  outputs=["data/processed/acs.parquet"], clean=True),
+            Stage("process_roads", d.process_roads,
+                  inputs=["data/shape_files/roads_*.zip", "data/interim/pumas.parquet",
+                          "data/external/state_codes.parquet"],
+                  outputs=["data/processed/roads/**/*.parquet"], clean=True),
+        ]
+        if database:
+            stages += [
+                Stage("insert_states", d.insert_states, inputs=["data/shape_files/states.zip"]),
+                Stage("insert_pumas", d.insert_pumas, inputs=["data/shape_files/puma_*.zip"]),
+                Stage("insert_roads", d.insert_roads, inputs=["data/shape_files/roads_*.zip"]),
+                Stage("insert_acs", d.insert_acs, inputs=["data/processed/acs.parquet"]),
+            ]
+        return stages
+
+    def dependencies(self, stage: Stage) -> set:
+        """
+        Returns the names of the stages that produce any of the inputs of `stage`.
+        """
+        deps = set(stage.after)
+        for other in self.stages.values():
+            if other is not stage and set(other.outputs) & set(stage.inputs):
+                deps.add(other.name)
+        return deps
+
+    def is_stale(self, stage: Stage, key: str) -> bool:
+        """
+        Checks whether a stage must be rebuilt.
+
+        Parameters
+        ----------
+        stage : Stage
+            The stage to check.
+        key : str
+            The current fingerprint of the stage inputs.
+
+        Returns
+        -------
+        bool
+            True if the stage never ran, its inputs changed or its outputs changed since it last ran.
+        """
+        record = self.state.get(stage.name)
+        if record is None or record.get("inputs") != key:
+            return True
+        return bool(stage.outputs) and record["outputs"] != DataStore.fingerprint(stage.outputs)
+
+    def build(self, stage: Stage) -> bool:
+        """
+        Rebuilds a stage if it is stale and records its new fingerprints.
+
+        Returns
+        -------
+        bool
+            True if the stage was rebuilt.
+        """
+        key = stage.input_key()
+        if not self.is_stale(stage, key):
+            if self.debug:
+                print("\033[0;36mNOTICE: \033[0m" + f"Stage {stage.name} is up to date")
+            return False
+        record = self.state.get(stage.name, {})
+        interrupted = record.get("started") == key and record.get("inputs") != key
+        if stage.clean and not interrupted:
+            stage.remove_outputs()
+        with self.lock:
+            self.state[stage.name] = {**record, "started": key}
+            self.save()
+        try:
+            stage.run()
+        except Exception:
+            # forget the previous fingerprints so the stage stays stale and resumes next run
+            with self.lock:
+                self.state[stage.name] = {"started": key}
+                self.save()
+            raise
+        with self.lock:
+            self.state[stage.name] = {"started": key, "inputs": key, "outputs": DataStore.fingerprint(stage.outputs)}
+            self.save()
+        if self.debug:
+            print("\033[0;32mINFO: \033[0m" + f"Finished stage {stage.name}")
+        return True
+
+    def save(self) -> None:
+        """
+        Writes the recorded fingerprints to disk atomically. Callers must hold `self.lock`.
+        """
+        with DataStore.atomic_write(self.state_file) as tmp, open(tmp, "w") as file:
+            json.dump(self.state, file, indent=2, sort_keys=True)
+
+    def run(self, targets=None) -> list:
+        """
+        Runs the pipeline, rebuilding only stale stages and running independent stages in parallel.
+
+        Parameters
+        ----------
+        targets : list, optional
+            Names of the stages to bring up to date, together with everything they depend on.
+            If None, all stages are considered. The default is None.
+
+        Returns
+        -------
+        list
+            The names of the stages that were rebuilt.
+
+        Raises
+        ------
+        RuntimeError
+            If a stage failed. Stages that do not depend on it still run, and the failed stage
+            keeps its `started` marker without new fingerprints, so the next run retries it.
+        """
+        deps = {name: self.dependencies(stage) for name, stage in self.stages.items()}
+        selected = set(targets or self.stages)
+        frontier = list(selected)
+        while frontier:
+            for dep in deps[frontier.pop()]:
+                if dep not in selected:
+                    selected.add(dep)
+                    frontier.append(dep)
+
+        done, failed, rebuilt, running = set(), set(), [], {}
+        with ThreadPoolExecutor(max_workers=self.max_stages) as executor:
+            while len(done | failed) < len(selected):
+                for name in sorted(selected - done - failed - set(running.values())):
+                    if deps[name] & selected & failed:
+                        # a stage whose dependency failed is not run and stays stale
+                        failed.add(name)
+                    elif deps[name] & selected <= done:
+                        running[executor.submit(self.build, self.stages[name])] = name
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        print("\033[1;33mWARNING: \033[0m" + f"Stage {name} failed: {future.exception()}")
+                        failed.add(name)
+                        continue
+                    if future.result():
+                        rebuilt.append(name)
+                    done.add(name)
+        if failed:
+            raise RuntimeError(f"{len(failed)} stages failed or were skipped: {', '.join(sorted(failed))}")
+        return rebuilt
+
+
+if __name__ == "__main__":
+    DataPipeline(debug=True).run()
@@ -1,76 +1,170 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from src.data.data_store import DataStore
 from src.data.data_pull import DataPull
+from functools import cached_property
+import pyarrow.parquet as pq
+import pyarrow as pa
+import pyogrio
 import geopandas as gpd
 import pandas as pd
 import polars as pl
-import cpi
+import multiprocessing
+import numpy as np
+import shapely
 import os
 
 
 class DataProcess(DataPull):
     """
     A class to process various indices from raw data and save them to processed files.
+    Nothing is processed on construction; the process methods are run as stages by `DataPipeline`.
 
     Parameters
     ----------
-    end_year : int
-        The end year for data processing.
-    file_remove : bool, optional
-        If True, removes the raw data files after processing. The default is False.
     debug : bool, optional
         If True, enables debug messages. The default is False.
+    jobs : int, optional
+        Number of worker processes used to compute road lengths. If 1, partitions are
+        processed serially in the current process. The default is the number of CPUs.
+    incremental : bool, optional
+        If True, road lengths after the first year are derived from the previous year plus
+        the length of the added, removed or changed segments only. The default is False.
+    streaming : bool, optional
+        If True, ACS data is aggregated on the Polars streaming engine in batches of states
+        and written to disk batch by batch instead of being collected in memory. The default is False.
+    memory_budget : int, optional
+        Approximate peak memory, in MB, of a streaming ACS batch. The default is 1024.
     """
 
-    def __init__(self, debug=False):
-        super().__init__()
-        self.debug = debug
-        self.pumas = self.process_pumas()
-        self.process_states()
-        self.process_county()
-        self.process_acs()
-        self.process_roads()
+    # raw ACS columns read by `aggregate_acs`; everything else is pruned at scan time
+    acs_columns = ["year", "state", "PUMA", "SEX", "PWGTP", "JWTR", "JWMNP", "HINCP", "ADJINC",
+                   "RACAIAN", "RACASN", "RACBLK", "RACNUM", "RACWHT", "RACSOR", "HISP"]
+    # estimated peak bytes per raw ACS record in a streaming batch: ~130 for the 16 projected
+    # columns, ~160 for the 20 columns of the derived records and ~220 for their income rows
+    # expanded to about four (sex, race) subgroups each, rounded to 512
+    acs_record_bytes = 512
+
+    def __init__(self, debug=False, jobs=None, incremental=False, streaming=False, memory_budget=1024, **kwargs):
+        super().__init__(debug=debug, **kwargs)
+        self.jobs = jobs or os.cpu_count()
+        self.incremental = incremental
+        self.streaming = streaming
+        self.memory_budget = memory_budget
+
+    @cached_property
+    def pumas(self) -> gpd.GeoDataFrame:
+        """
+        The PUMA geometries, processed on first use.
+        """
+        return self.process_pumas()
 
     def process_states(self) -> None:
         """
-        Process and save state geometries from shapefiles to an interim file.
+        Process and save state geometries from shapefiles to an interim GeoParquet file.
         """
-        if not os.path.exists("data/interim/states.gpkg"):
+        if not os.path.exists("data/interim/states.parquet"):
             gdf = gpd.read_file("data/shape_files/states.zip", engine="pyogrio")
-            gdf.to_file("data/interim/states.gpkg", driver="GPKG")
+            DataStore.write_geoparquet(gdf, "data/interim/states.parquet", sort_by="STATEFP")
             if self.debug:
                 print("\033[0;36mINFO: \033[0m" + "Finished processing states")
 
     def process_county(self) -> None:
         """
-        Process and save county geometries from shapefiles to an interim file.
+        Process and save county geometries from shapefiles to an interim GeoParquet file.
         """
-        if not os.path.exists("data/interim/counties.gpkg"):
+        if not os.path.exists("data/interim/counties.parquet"):
             gdf = gpd.read_file("data/shape_files/counties.zip", engine="pyogrio")
-            gdf.to_file("data/interim/counties.gpkg", driver="GPKG")
+            DataStore.write_geoparquet(gdf, "data/interim/counties.parquet", sort_by="STATEFP")
             if self.debug:
                 print("\033[0;36mINFO: \033[0m" + "Finished processing counties")
 
     def process_pumas(self) -> gpd.GeoDataFrame:
         """
-        Process and save PUMA geometries from shapefiles to an interim file.
+        Process and save PUMA geometries from shapefiles to an interim GeoParquet file,
+        sorted and grouped by state. Every state's shapefile is read concurrently through
+        pyogrio's Arrow interface with only the needed columns, and the tables are combined
+        with a single concat. If the interim file already exists it is read instead.
 
         Returns
         -------
         gpd.GeoDataFrame
             A GeoDataFrame containing PUMA geometries.
         """
-        puma_df = gpd.GeoDataFrame(columns=["puma_id", "name", "geometry"])
-        if not os.path.exists("data/interim/pumas.gpkg"):
-            for file in os.listdir("data/shape_files"):
-                if file.startswith("puma"):
-                    gdf = gpd.read_file(f"data/shape_files/{file}", engine="pyogrio").set_crs(3857, allow_override=True)
-                    gdf = gdf[["GEOID10", "NAMELSAD10", "geometry"]].copy()
-                    gdf = gdf.rename(columns={"GEOID10": "puma_id", "NAMELSAD10": "name"})
-                    puma_df = pd.concat([puma_df, gdf], ignore_index=True, verify_integrity=True)
-            puma_df.to_file("data/interim/pumas.gpkg", driver="GPKG")
+        if os.path.exists("data/interim/pumas.parquet"):
+            return DataStore.read_geoparquet("data/interim/pumas.parquet", columns=["puma_id", "name", "geometry"])
+
+        files = sorted(f"data/shape_files/{file}" for file in os.listdir("data/shape_files") if file.startswith("puma"))
+        with ThreadPoolExecutor(max_workers=max(1, min(self.jobs, len(files)))) as executor:
+            tables = list(executor.map(self.read_puma, files))
+
+        table = pa.concat_tables(tables) if tables else pa.table({
+            "puma_id": pa.array([], pa.string()), "name": pa.array([], pa.string()), "geometry": pa.array([], pa.binary())})
+        puma_df = gpd.GeoDataFrame({
+            "puma_id": table.column("puma_id").to_numpy(zero_copy_only=False),
+            "name": table.column("name").to_numpy(zero_copy_only=False),
+        }, geometry=shapely.from_wkb(table.column("geometry").to_numpy(zero_copy_only=False)), crs=3857)
+        puma_df["state_id"] = puma_df["puma_id"].str[:2]
+        puma_df = puma_df.sort_values("state_id", kind="stable").reset_index(drop=True)
+        DataStore.write_geoparquet(puma_df, "data/interim/pumas.parquet", sort_by="state_id")
         if self.debug:
             print("\033[0;36mINFO: \033[0m" + "Finished processing pumas")
-        return puma_df
+        return puma_df[["puma_id", "name", "geometry"]]
+
+    @staticmethod
+    def read_puma(file: str) -> pa.Table:
+        """
+        Read the identifiers, names and WKB geometries of one PUMA shapefile as an Arrow table.
+
+        Parameters
+        ----------
+        file : str
+            The path of the zipped shapefile.
+
+        Returns
+        -------
+        pa.Table
+            A table with columns puma_id, name and geometry.
+        """
+        meta, table = pyogrio.read_arrow(file, columns=["GEOID10", "NAMELSAD10"])
+        return pa.table({
+            "puma_id": table.column("GEOID10").cast(pa.string()),
+            "name": table.column("NAMELSAD10").cast(pa.string()),
+            "geometry": table.column(meta["geometry_name"] or "wkb_geometry").cast(pa.binary()),
+        })
+
+    def process_geojson(self) -> None:
+        """
+        Build the simplified, quantized GeoJSON of every state's PUMAs at each zoom level of
+        `DataStore.geojson_levels`. The PUMAs of a state are simplified as one coverage, so
+        shared boundaries stay shared. Coordinates are snapped to the level's grid
+        and every feature is keyed by `properties.puma_id`, so the app can serve the files
+        as they are and send only the values with each figure.
+        """
+        os.makedirs(DataStore.geojson_path, exist_ok=True)
+        pumas = DataStore.read_geoparquet("data/interim/pumas.parquet", columns=["puma_id", "state_id", "geometry"])
+        for state_id, gdf in pumas.groupby("state_id"):
+            for zoom, (tolerance, grid) in DataStore.geojson_levels.items():
+                path = DataStore.geojson_file(state_id, zoom)
+                if os.path.exists(path):
+                    continue
+                geoms = DataStore.simplify(gdf.geometry.to_numpy(), tolerance, grid)
+                features = ",".join(
+                    f'{{"type":"Feature","id":"{puma_id}","properties":{{"puma_id":"{puma_id}"}},"geometry":{geometry}}}'
+                    for puma_id, geometry in zip(gdf["puma_id"], shapely.to_geojson(geoms))
+                    if geometry is not None
+                )
+                with DataStore.atomic_write(path) as tmp, open(tmp, "w") as file:
+                    file.write(f'{{"type":"FeatureCollection","features":[{features}]}}')
+            if self.debug:
+                print("\033[0;36mINFO: \033[0m" + f"Finished processing geojson for {state_id}")
+
+    def process_weights(self) -> None:
+        """
+        Build and cache the Queen, Rook and KNN spatial weights of the PUMAs. SpatialWeights is
+        imported here so that scipy is only loaded by the stage that needs it.
+        """
+        from src.features.spatial_weights import SpatialWeights
+        SpatialWeights(debug=self.debug).build()
 
     def process_acs(self) -> None:
         """
@@ -102,81 +196,318 @@ class DataProcess(DataPull):
         acs = pl.DataFrame(empty_df).clear()
 
         if not os.path.exists("data/processed/acs.parquet"):
-            for file in os.listdir("data/raw"):
-                if file.startswith("acs"):
-                    original = pl.read_parquet(f"data/raw/{file}")
-                    for sex in [1, 2, 3]:
-                        for race in [
-                                "RACAIAN", "RACASN", "RACBLK", "RACNUM", "RACWHT", "RACSOR", "HISP", "ALL"]:
-                            df = original
-                            if sex != 3:
-                                df = df.filter(pl.col("SEX") == sex)
-                            if race != "ALL":
-                                df = df.filter(pl.col(race) == 1)
-                            df = df.filter(pl.col("JWMNP") > 0)
-                            df = df.with_columns(
-                                pl.when(pl.col("JWTR") == 1).then(pl.col("PWGTP")).otherwise(0).alias("car"),
-                                pl.when(pl.col("JWTR") == 2).then(pl.col("PWGTP")).otherwise(0).alias("bus"),
-                                pl.when(pl.col("JWTR") == 3).then(pl.col("PWGTP")).otherwise(0).alias("streetcar"),
-                                pl.when(pl.col("JWTR") == 4).then(pl.col("PWGTP")).otherwise(0).alias("subway"),
-                                pl.when(pl.col("JWTR") == 5).then(pl.col("PWGTP")).otherwise(0).alias("railroad"),
-                                pl.when(pl.col("JWTR") == 6).then(pl.col("PWGTP")).otherwise(0).alias("ferry"),
-                                pl.when(pl.col("JWTR") == 7).then(pl.col("PWGTP")).otherwise(0).alias("taxi"),
-                                pl.when(pl.col("JWTR") == 8).then(pl.col("PWGTP")).otherwise(0).alias("motorcycle"),
-                                pl.when(pl.col("JWTR") == 9).then(pl.col("PWGTP")).otherwise(0).alias("bicycle"),
-                                pl.when(pl.col("JWTR") == 10).then(pl.col("PWGTP")).otherwise(0).alias("walking"),
-                                pl.when(pl.col("JWTR") == 11).then(pl.col("PWGTP")).otherwise(0).alias("home"),
-                                pl.when(pl.col("JWTR") == 12).then(pl.col("PWGTP")).otherwise(0).alias("other")
-                            )
-                            df = df.with_columns(total_time=(pl.col("PWGTP") * pl.col("JWMNP")))
-                            year = df.select(pl.col("year")).unique().item()
-                            df = df.group_by("year", "state", "PUMA").agg(
-                                pl.col("PWGTP", "total_time", "car", "bus", "streetcar", "subway", "railroad",
-                                       "ferry", "taxi", "motorcycle", "bicycle", "walking", "home", "other").sum(),
-                                (cpi.inflate(pl.col("HINCP"), year)).median()
-                            )
-                            df = df.with_columns(
-                                (pl.col("total_time") / pl.col("PWGTP")).alias("avg_time"),
-                                sex=pl.lit(sex),
-                                race=pl.lit(race),
-                            )
-                            acs = pl.concat([acs, df], how="vertical")
-            acs.write_parquet("data/processed/acs.parquet")
+            files = sorted(f"data/raw/{file}" for file in os.listdir("data/raw") if file.startswith("acs"))
+            if self.streaming:
+                self.stream_acs(files, "data/processed/acs.parquet", acs.schema)
+            else:
+                if files:
+                    df = self.aggregate_acs(pl.scan_parquet(files).select(self.acs_columns), self.pull_cpi()).collect()
+                    acs = pl.concat([acs, df.select(acs.columns)], how="vertical")
+                acs.write_parquet("data/processed/acs.parquet")
             if self.debug:
                 print("\033[0;36mINFO: \033[0m" + "Finished processing acs")
 
+    def stream_acs(self, files: list, output: str, schema: dict) -> None:
+        """
+        Aggregate the ACS files with bounded memory and write the result straight to disk.
+        Each file is scanned lazily with only `acs_columns` projected, its states are packed
+        into batches whose records fit in `memory_budget`, and every batch is aggregated on the
+        streaming engine and appended to the output as its own row group. Subgroups never span
+        states, so batches are independent. The output is written to a temporary file and only
+        moved into place once complete.
+
+        Parameters
+        ----------
+        files : list
+            The raw ACS parquet files to aggregate.
+        output : str
+            The parquet file to write.
+        schema : dict
+            The schema of the output.
+        """
+        budget = max(1, self.memory_budget * 2**20 // self.acs_record_bytes)
+        chunk_size = max(1_000, budget // (4 * pl.thread_pool_size()))
+        deflators = self.pull_cpi()
+        target = pl.DataFrame(schema=schema).to_arrow().schema
+
+        # the chunk size is restored on exit, so other queries of the process keep theirs
+        with pl.Config(streaming_chunk_size=chunk_size), DataStore.atomic_write(output) as tmp, \
+                pq.ParquetWriter(tmp, target) as writer:
+            for file in files:
+                lf = pl.scan_parquet(file).select(self.acs_columns)
+                counts = lf.group_by("state").agg(pl.len()).sort("state").collect(streaming=True).rows()
+
+                batches, batch, size = [], [], 0
+                for state, n in counts:
+                    if batch and size + n > budget:
+                        batches.append(batch)
+                        batch, size = [], 0
+                    batch.append(state)
+                    size += n
+                if batch:
+                    batches.append(batch)
+
+                for batch in batches:
+                    df = self.aggregate_acs(lf.filter(pl.col("state").is_in(batch)), deflators, streaming=True)
+                    df = df.select(pl.col(name).cast(dtype) for name, dtype in schema.items()).collect(streaming=True)
+                    writer.write_table(df.to_arrow().cast(target))
+                if self.debug:
+                    print("\033[0;36mINFO: \033[0m" + f"Streamed {file} in {len(batches)} batches")
+
+    @staticmethod
+    def aggregate_acs(lf: pl.LazyFrame, deflators: pl.DataFrame, streaming=False) -> pl.LazyFrame:
+        """
+        Aggregate ACS person records into commute totals for every (sex, race) subgroup of
+        every PUMA in a single lazy query. The travel modes are pivoted once, records are
+        summed into cells of identical sex and race flags, and a small membership table
+        expands every cell to the subgroups it belongs to (its own sex and "all sexes", each
+        race flag it has and "ALL") before one final group_by. Only the income column is
+        expanded per record, since its median cannot be rolled up from cells.
+
+        Parameters
+        ----------
+        lf : pl.LazyFrame
+            The raw ACS records of one or more years.
+        deflators : pl.DataFrame
+            The year to deflator table returned by `pull_cpi`.
+        streaming : bool, optional
+            If True, the records are scanned once per branch instead of being cached, since the
+            streaming engine cannot run cache nodes. The default is False.
+
+        Returns
+        -------
+        pl.LazyFrame
+            The aggregated ACS data with one row per year, state, PUMA, sex and race.
+        """
+        races = ["RACAIAN", "RACASN", "RACBLK", "RACNUM", "RACWHT", "RACSOR", "HISP"]
+        modes = ["car", "bus", "streetcar", "subway", "railroad", "ferry",
+                 "taxi", "motorcycle", "bicycle", "walking", "home", "other"]
+        sums = ["PWGTP", "total_time", *modes]
+        keys = ["year", "state", "PUMA", "sex", "race"]
+
+        members = pl.DataFrame([
+            (SEX, mask, sex, race)
+            for SEX in [1, 2]
+            for sex in [SEX, 3]
+            for mask in range(1 << len(races))
+            for i, race in enumerate([*races, "ALL"])
+            if race == "ALL" or mask >> i & 1
+        ], schema={"SEX": pl.Int64, "mask": pl.Int64, "sex": pl.Int32, "race": pl.String}, orient="row").lazy()
+
+        records = lf.filter(pl.col("JWMNP") > 0).join(deflators.lazy(), on="year", how="left").select(
+            "year", "state", "PUMA", "SEX", "PWGTP",
+            *[pl.when(pl.col("JWTR") == i).then(pl.col("PWGTP")).otherwise(0).alias(mode)
+              for i, mode in enumerate(modes, start=1)],
+            total_time=(pl.col("PWGTP") * pl.col("JWMNP")),
+            HINCP=DataProcess.adjust_income(pl.col("deflator")),
+            mask=pl.sum_horizontal((pl.col(race) == 1).cast(pl.Int64) * (1 << i) for i, race in enumerate(races)),
+        )
+        if not streaming:
+            records = records.cache()
+
+        totals = (
+            records.group_by("year", "state", "PUMA", "SEX", "mask").agg(pl.col(sums).sum())
+            .join(members, on=["SEX", "mask"])
+            .group_by(keys).agg(pl.col(sums).sum())
+        )
+        income = (
+            records.select("year", "state", "PUMA", "SEX", "mask", "HINCP")
+            .join(members, on=["SEX", "mask"])
+            .group_by(keys).agg(pl.col("HINCP").median())
+        )
+        return (
+            totals.join(income, on=keys)
+            .with_columns((pl.col("total_time") / pl.col("PWGTP")).alias("avg_time"))
+            .select("year", "state", "PUMA", *sums, "HINCP", "avg_time", "sex", "race")
+        )
+
+    @staticmethod
+    def adjust_income(deflator: pl.Expr) -> pl.Expr:
+        """
+        Express household income in constant dollars: HINCP is first brought to survey-year
+        dollars with the ACS ADJINC factor and then deflated to the CPI base year.
+
+        Parameters
+        ----------
+        deflator : pl.Expr
+            The CPI deflator of the record's year.
+
+        Returns
+        -------
+        pl.Expr
+            The adjusted household income.
+        """
+        adjinc = pl.col("ADJINC").cast(pl.Float64)
+        # older releases encode ADJINC with six implied decimal places
+        adjinc = pl.when(adjinc > 10).then(adjinc / 1_000_000).otherwise(adjinc)
+        return pl.col("HINCP") * adjinc * deflator
+
     def process_roads(self) -> None:
         """
-        Process and save road data from shapefiles to a parquet file.
+        Process road data from shapefiles and save the road lengths as a hive-partitioned
+        dataset under data/processed/roads, one partition per (year, state). Every partition
+        is written as soon as it is computed and existing partitions are skipped, so an
+        interrupted run resumes where it stopped.
         """
-        empty_df = [
-            pl.Series("year", [], dtype=pl.Int64),
-            pl.Series("state_id", [], dtype=pl.String),
-            pl.Series("puma_id", [], dtype=pl.String),
-            pl.Series("length", [], dtype=pl.Float64),
-        ]
-        master_df = pl.DataFrame(empty_df).clear()
+        years = list(range(2012, 2020))
+        tasks = []
+        for state in self.codes.select(pl.col("fips")).to_series().to_list():
+            missing = [year for year in years if not os.path.exists(DataStore.road_partition(year, state))]
+            if not missing:
+                continue
+            pumas = self.pumas[self.pumas["puma_id"].str.startswith(str(state).zfill(2))]
+            puma_ids = pumas["puma_id"].tolist()
+            puma_wkb = shapely.to_wkb(pumas.geometry.to_numpy())
+            if self.incremental:
+                # every year builds on the previous one, so the state is recomputed from the base year
+                tasks.append((self.road_length_state, (state, years, puma_ids, puma_wkb, self.debug), state))
+            else:
+                for year in missing:
+                    tasks.append((self.road_length_partition, (state, year, puma_ids, puma_wkb, self.debug), f"{state} {year}"))
 
-        if not os.path.exists("data/processed/roads.parquet"):
-            for year in range(2012, 2020):
-                for state in self.codes.select(pl.col("fips")).to_series().to_list():
-                    roads_df = gpd.GeoDataFrame(columns=['linear_id', 'year', 'geometry'])
-                    for file in os.listdir("data/shape_files/"):
-                        if file.startswith(f"roads_{year}_{str(state).zfill(2)}"):
-                            gdf = gpd.read_file(f"data/shape_files/{file}", engine="pyogrio")
-                            gdf.rename(columns={"LINEARID": "linear_id"}, inplace=True)
-                            gdf[["county_id", "year"]] = "01063", year
-                            gdf = gdf[["year", "linear_id", "county_id", "geometry"]].set_crs(3857, allow_override=True)
+        if self.jobs > 1:
+            # polars is not fork-safe, so workers are spawned
+            with ProcessPoolExecutor(max_workers=self.jobs, mp_context=multiprocessing.get_context("spawn")) as executor:
+                futures = {executor.submit(func, *args): name for func, args, name in tasks}
+                for future in as_completed(futures):
+                    DataStore.write_roads(pl.read_ipc(future.result()))
+                    print("\033[0;35mMERGE STATE: \033[0m" + f"Finished processing roads for {futures[future]}")
+        else:
+            for func, args, name in tasks:
+                DataStore.write_roads(pl.read_ipc(func(*args)))
+                print("\033[0;35mMERGE STATE: \033[0m" + f"Finished processing roads for {name}")
 
-                            roads_df = pd.concat([roads_df, gdf], ignore_index=True)
-                            if self.debug:
-                                print("\033[0;36mREAD: \033[0m" + f"Finished processing roads for {file}")
+    @staticmethod
+    def road_length_partition(state_id: str, year: int, puma_ids: list, puma_wkb: np.ndarray, debug=False) -> bytes:
+        """
+        Compute the road length of every PUMA of one (state, year) partition. Runs in a
+        worker process: roads are read from disk by the worker and the PUMA geometries
+        travel as WKB, so no GeoDataFrame is pickled in either direction.
+
+        Parameters
+        ----------
+        state_id : str
+            The state identifier.
+        year : int
+            The year of the road data.
+        puma_ids : list
+            The PUMA identifiers of the state.
+        puma_wkb : np.ndarray
+            The PUMA geometries of the state encoded as WKB, in the order of `puma_ids`.
+        debug : bool, optional
+            If True, enables debug messages. The default is False.
+
+        Returns
+        -------
+        bytes
+            The road lengths as an Arrow IPC buffer with columns year, state_id, puma_id and length.
+        """
+        roads = DataProcess.read_roads(state_id, year, debug)
+        lengths = DataProcess.overlay_length(roads.geometry.to_numpy(), shapely.from_wkb(puma_wkb))
+        df = pl.DataFrame({
+            "year": year,
+            "state_id": str(state_id).zfill(2),
+            "puma_id": puma_ids,
+            "length": lengths,
+        }, schema={"year": pl.Int64, "state_id": pl.String, "puma_id": pl.String, "length": pl.Float64})
+        return df.write_ipc(None).getvalue()
+
+    @staticmethod
+    def road_length_state(state_id: str, years: list, puma_ids: list, puma_wkb: np.ndarray, debug=False) -> bytes:
+        """
+        Compute the road length of every PUMA of a state for consecutive years incrementally.
+        The first year is overlaid in full; every later year diffs its segments against the
+        previous year by LINEARID and geometry hash and only overlays the segments that were
+        added, removed or changed, adding or subtracting their lengths from the running totals.
 
-                    tmp = self.process_length(roads_df, state, year, empty_df)
-                    master_df = pl.concat([master_df, tmp], how="vertical")
-                    print("\033[0;35mMERGE STATE: \033[0m" + f"Finished processing roads for {state}")
+        Parameters
+        ----------
+        state_id : str
+            The state identifier.
+        years : list
+            The consecutive years of road data, base year first.
+        puma_ids : list
+            The PUMA identifiers of the state.
+        puma_wkb : np.ndarray
+            The PUMA geometries of the state encoded as WKB, in the order of `puma_ids`.
+        debug : bool, optional
+            If True, enables debug messages. The default is False.
+
+        Returns
+        -------
+        bytes
+            The road lengths as an Arrow IPC buffer with columns year, state_id, puma_id and length.
+        """
+        polygons = shapely.from_wkb(puma_wkb)
+        frames = []
+        previous = None
+        for year in years:
+            roads = DataProcess.read_roads(state_id, year, debug)
+            geoms = roads.geometry.to_numpy()
+            # typed explicitly: a year without road files has no rows to infer the dtypes from
+            keys = pl.DataFrame({
+                "linear_id": roads["linear_id"].astype(str).tolist(),
+                "hash": pl.Series(shapely.to_wkb(geoms).tolist(), dtype=pl.Binary).hash(),
+            }, schema={"linear_id": pl.String, "hash": pl.UInt64}).with_columns(
+                occurrence=pl.int_range(pl.len()).over("linear_id", "hash")
+            ).with_row_index()
+
+            if previous is None:
+                totals = DataProcess.overlay_length(geoms, polygons)
+            else:
+                prev_keys, prev_geoms = previous
+                on = ["linear_id", "hash", "occurrence"]
+                added = keys.join(prev_keys, on=on, how="anti")["index"].to_numpy()
+                removed = prev_keys.join(keys, on=on, how="anti")["index"].to_numpy()
+                totals = (totals
+                          + DataProcess.overlay_length(geoms[added], polygons)
+                          - DataProcess.overlay_length(prev_geoms[removed], polygons))
+                totals = np.maximum(totals, 0)
+                if debug:
+                    print("\033[0;36mINFO: \033[0m" + f"Roads {str(state_id).zfill(2)} {year}: "
+                          f"{len(added)} added, {len(removed)} removed of {len(keys)} segments")
 
-            master_df.write_parquet("data/processed/roads.parquet")
+            frames.append(pl.DataFrame({
+                "year": year,
+                "state_id": str(state_id).zfill(2),
+                "puma_id": puma_ids,
+                "length": totals,
+            }, schema={"year": pl.Int64, "state_id": pl.String, "puma_id": pl.String, "length": pl.Float64}))
+            previous = (keys, geoms)
+
+        return pl.concat(frames, how="vertical").write_ipc(None).getvalue()
+
+    @staticmethod
+    def read_roads(state_id: str, year: int, debug=False) -> gpd.GeoDataFrame:
+        """
+        Read the road shapefiles of every county in a state for a given year.
+
+        Parameters
+        ----------
+        state_id : str
+            The state identifier.
+        year : int
+            The year of the road data.
+        debug : bool, optional
+            If True, enables debug messages. The default is False.
+
+        Returns
+        -------
+        gpd.GeoDataFrame
+            A GeoDataFrame containing the road geometries of the state.
+        """
+        roads_df = gpd.GeoDataFrame(columns=['linear_id', 'year', 'geometry'])
+        for file in os.listdir("data/shape_files/"):
+            if file.startswith(f"roads_{year}_{str(state_id).zfill(2)}"):
+                gdf = gpd.read_file(f"data/shape_files/{file}", engine="pyogrio")
+                gdf.rename(columns={"LINEARID": "linear_id"}, inplace=True)
+                gdf[["county_id", "year"]] = "01063", year
+                gdf = gdf[["year", "linear_id", "county_id", "geometry"]].set_crs(3857, allow_override=True)
+
+                roads_df = pd.concat([roads_df, gdf], ignore_index=True)
+                if debug:
+                    print("\033[0;36mREAD: \033[0m" + f"Finished processing roads for {file}")
+        return roads_df
 
     def process_length(self, roads: pd.DataFrame, state_id: str, year: int, empty_df: list) -> pl.DataFrame:
         """
@@ -198,29 +529,53 @@ class DataProcess(DataPull):
         pl.DataFrame
             A DataFrame with the calculated road lengths.
         """
-        df = pl.DataFrame(empty_df)
         pumas = self.pumas[self.pumas["puma_id"].str.startswith(str(state_id).zfill(2))]
+        lengths = self.overlay_length(roads.geometry.to_numpy(), pumas.geometry.to_numpy())
+        df = pl.DataFrame({
+            "year": year,
+            "state_id": str(state_id).zfill(2),
+            "puma_id": pumas["puma_id"].tolist(),
+            "length": lengths,
+        }, schema=pl.DataFrame(empty_df).schema)
+        if self.debug:
+            print("\033[0;35mROAD LENGTH: \033[0m" + f"Finished processing roads for {str(state_id).zfill(2)} {year}")
+        return df
 
-        def process_puma(puma_id: str) -> pl.DataFrame:
-            tmp = pumas.loc[pumas["puma_id"] == puma_id]
-            clipped = roads.clip(tmp['geometry'])
-            leng = pl.DataFrame({
-                "year": year,
-                "state_id": str(state_id).zfill(2),
-                "puma_id": puma_id,
-                "length": clipped.length.sum()
-            })
-            print("\033[0;35mROAD LENGTH: \033[0m" + f"Finished processing roads for {puma_id}")
-            return leng
-
-        with ThreadPoolExecutor() as executor:
-            futures = [executor.submit(process_puma, puma_id) for puma_id in pumas["puma_id"]]
-            for future in as_completed(futures):
-                leng = future.result()
-                df = pl.concat([df, leng], how="vertical")
+    @staticmethod
+    def overlay_length(lines: np.ndarray, polygons: np.ndarray) -> np.ndarray:
+        """
+        Calculate the total length of the lines falling inside each polygon in a single
+        indexed pass. Candidate (line, polygon) pairs come from one bulk STRtree query;
+        lines lying entirely inside a polygon contribute their full length, and only lines
+        crossing a polygon boundary are split by an intersection.
 
-        return df
+        Parameters
+        ----------
+        lines : np.ndarray
+            Array of line geometries.
+        polygons : np.ndarray
+            Array of polygon geometries.
+
+        Returns
+        -------
+        np.ndarray
+            The total line length inside each polygon, in the order of `polygons`.
+        """
+        lines = lines[~shapely.is_missing(lines)]
+        if len(lines) == 0 or len(polygons) == 0:
+            return np.zeros(len(polygons))
+
+        tree = shapely.STRtree(polygons)
+        line_idx, poly_idx = tree.query(lines, predicate="intersects")
+        shapely.prepare(polygons)
+        inside = shapely.contains_properly(polygons[poly_idx], lines[line_idx])
+
+        length = shapely.length(lines[line_idx])
+        cross = ~inside
+        length[cross] = shapely.length(shapely.intersection(lines[line_idx[cross]], polygons[poly_idx[cross]]))
+        return np.bincount(poly_idx, weights=length, minlength=len(polygons))
 
 
 if __name__ == "__main__":
-    DataProcess()
+    from src.data.data_pipeline import DataPipeline
+    DataPipeline(debug=True).run()
@@ -1,39 +1,62 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from src.data.data_download import DataDownload
+from src.data.data_cache import DataCache
+from functools import cached_property
 from requests.exceptions import RequestException
-from urllib.request import urlretrieve
-from urllib.error import URLError
 from dotenv import load_dotenv
 import geopandas as gpd
 import polars as pl
-import requests
 import os
 
 load_dotenv()
 
 class DataPull:
     """
-    A class to pull various datasets and save them to specified files.
+    A class to pull various datasets and save them to specified files. Nothing is downloaded
+    on construction; the pull methods are run as stages by `DataPipeline`.
 
     Parameters
     ----------
     debug : bool, optional
         If True, enables debug messages. The default is False.
+    workers : int, optional
+        Number of concurrent downloads used for bulk pulls. The default is 16.
+    revalidate : bool, optional
+        If True, files already in the download manifest are revalidated with conditional
+        requests instead of being trusted as-is. The default is False.
     """
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, workers=16, revalidate=False):
         """
-        Initializes the DataPull class and pulls various datasets.
+        Initializes the DataPull class.
         """
         self.debug = debug
+        self.revalidate = revalidate
+        self.cache = DataCache(debug=debug)
+        self.downloader = DataDownload(workers=workers, cache=self.cache, debug=debug)
         self.key = os.environ.get('CENSUS_API_KEY')
-        self.mov = self.pull_movs()
-        self.codes = self.pull_state_codes()
+
+    @cached_property
+    def mov(self) -> pl.DataFrame:
+        """
+        The MOVs data, pulled on first use.
+        """
+        return self.pull_movs()
+
+    @cached_property
+    def codes(self) -> pl.DataFrame:
+        """
+        The state codes, built on first use.
+        """
+        return self.pull_state_codes()
+
+    @cached_property
+    def county_codes(self) -> pl.DataFrame:
+        """
+        The county codes, built on first use.
+        """
         self.pull_counties()
-        self.county_codes = self.pull_county_codes()
-        self.pull_states()
-        # self.pull_blocks()
-        self.pull_pumas()
-        self.pull_roads()
-        self.pull_acs()
+        return self.pull_county_codes()
 
     def pull_movs(self) -> pl.DataFrame:
         """
@@ -66,6 +89,31 @@ class DataPull:
                 print("\033[0;36mPROCESS: \033[0m" + "Finished processing state_codes.parquet")
         return pl.read_parquet("data/external/state_codes.parquet")
 
+    def pull_cpi(self) -> pl.DataFrame:
+        """
+        Builds a year to deflator table from the CPI-U annual averages and saves it to a parquet
+        file, so income can be adjusted offline with a plain multiply after the first build.
+
+        Returns
+        -------
+        pl.DataFrame
+            A DataFrame with the deflator of every year to the latest CPI year.
+        """
+        if not os.path.exists("data/external/cpi.parquet"):
+            # the cpi package loads its database on import, so it is only imported when needed
+            import cpi
+            years = list(range(2000, cpi.LATEST_YEAR + 1))
+            target = cpi.get(cpi.LATEST_YEAR)
+            cpi_df = pl.DataFrame({
+                "year": years,
+                "deflator": [target / float(cpi.get(year)) for year in years],
+                "base_year": cpi.LATEST_YEAR,
+            }, schema={"year": pl.Int64, "deflator": pl.Float64, "base_year": pl.Int64})
+            cpi_df.write_parquet("data/external/cpi.parquet")
+            if self.debug:
+                print("\033[0;36mPROCESS: \033[0m" + "Finished processing cpi.parquet")
+        return pl.read_parquet("data/external/cpi.parquet")
+
     def pull_county_codes(self) -> pl.DataFrame:
         """
         Pulls county codes from shapefiles and saves them to a parquet file.
@@ -101,100 +149,137 @@ class DataPull:
         """
         Pulls block shapefiles for each state from the Census Bureau and saves them locally.
         """
+        jobs = []
         for state, name in self.codes.select(pl.col("fips", "state_name")).rows():
             url = f"https://www2.census.gov/geo/tiger/TIGER2023/TABBLOCK20/tl_2023_{str(state).zfill(2)}_tabblock20.zip"
             file_name = f"data/shape_files/block_{name}_{str(state).zfill(2)}.zip"
-            self.pull_file(url, file_name)
+            jobs.append((url, file_name))
+        self.pull_files(jobs)
 
     def pull_pumas(self) -> None:
         """
         Pulls PUMA shapefiles for each state from the Census Bureau and saves them locally.
         """
+        jobs = []
         for state, name in self.codes.select(pl.col("fips", "state_name")).rows():
             url = f"https://www2.census.gov/geo/tiger/TIGER2019/PUMA/tl_2019_{str(state).zfill(2)}_puma10.zip"
             file_name = f"data/shape_files/puma_{name}_{str(state).zfill(2)}.zip"
-            self.pull_file(url, file_name)
+            jobs.append((url, file_name))
+        self.pull_files(jobs)
 
     def pull_roads(self) -> None:
         """
         Pulls road shapefiles for each county and year from the Census Bureau and saves them locally.
         """
+        jobs = []
         for year in range(2012, 2020):
             for county_id, county_name in self.county_codes.select(pl.col("county_id", "NAME")).rows():
                 url = f"https://www2.census.gov/geo/tiger/TIGER{year}/ROADS/tl_{year}_{county_id}_roads.zip"
                 file_name = f"data/shape_files/roads_{year}_{county_id}.zip"
-                self.pull_file(url, file_name)
+                jobs.append((url, file_name))
+        self.pull_files(jobs)
 
     def pull_acs(self) -> None:
         """
         Pulls ACS data for each state and year from the Census API and saves it to a parquet file.
+
+        Every missing (state, year) pair is requested concurrently through the pooled session
+        at a bounded request rate, and each year is written with a single concat once all of
+        its states have arrived. A year with a failed state is not written, so the next run
+        requests it again.
+
+        Raises
+        ------
+        RuntimeError
+            If any state could not be downloaded, once every other year has been written.
         """
-        empty_df = [
-            pl.Series("JWMNP", [], dtype=pl.Int64),
-            pl.Series("SEX", [], dtype=pl.Int64),
-            pl.Series("ST", [], dtype=pl.Int64),
-            pl.Series("ADJHSG", [], dtype=pl.String),
-            pl.Series("ADJINC", [], dtype=pl.String),
-            pl.Series("AGEP", [], dtype=pl.Int64),
-            pl.Series("CIT", [], dtype=pl.Int64),
-            pl.Series("JWTR", [], dtype=pl.Int64),  # Check
-            pl.Series("JWRIP", [], dtype=pl.Int64),
-            pl.Series("OC", [], dtype=pl.Int64),
-            pl.Series("HINCP", [], dtype=pl.Int64),
-            pl.Series("RACAIAN", [], dtype=pl.Int64),
-            pl.Series("RACASN", [], dtype=pl.Int64),
-            pl.Series("RACBLK", [], dtype=pl.Int64),
-            pl.Series("RACNUM", [], dtype=pl.Int64),
-            pl.Series("RACWHT", [], dtype=pl.Int64),
-            pl.Series("RACSOR", [], dtype=pl.Int64),
-            pl.Series("HISP", [], dtype=pl.Int64),
-            pl.Series("PWGTP", [], dtype=pl.Int64),
-            pl.Series("COW", [], dtype=pl.Int64),
-            pl.Series("PUMA", [], dtype=pl.Int64),
-            pl.Series("state", [], dtype=pl.Int64),
-            pl.Series("year", [], dtype=pl.Int64),
-        ]
+        schema = {
+            "JWMNP": pl.Int64,
+            "SEX": pl.Int64,
+            "ST": pl.Int64,
+            "ADJHSG": pl.String,
+            "ADJINC": pl.String,
+            "AGEP": pl.Int64,
+            "CIT": pl.Int64,
+            "JWTR": pl.Int64,  # Check
+            "JWRIP": pl.Int64,
+            "OC": pl.Int64,
+            "HINCP": pl.Int64,
+            "RACAIAN": pl.Int64,
+            "RACASN": pl.Int64,
+            "RACBLK": pl.Int64,
+            "RACNUM": pl.Int64,
+            "RACWHT": pl.Int64,
+            "RACSOR": pl.Int64,
+            "HISP": pl.Int64,
+            "PWGTP": pl.Int64,
+            "COW": pl.Int64,
+            "PUMA": pl.Int64,
+            "state": pl.Int64,
+            "year": pl.Int64,
+        }
 
         param = 'JWMNP,SEX,ST,ADJHSG,ADJINC,AGEP,CIT,JWTR,JWRIP,OC,HINCP,RACAIAN,RACASN,RACBLK,RACNUM,RACWHT,RACSOR,HISP,PWGTP,COW,PUMA'
         base = 'https://api.census.gov/data/'
         flow = '/acs/acs1/pums'
 
+        jobs = []
         for year in range(2012, 2020):
             if os.path.exists(f"data/raw/acs_{year}.parquet"):
                 print("\033[0;32mINFO: \033[0m" + f"ACS data for {year} already exists")
                 continue
+            year_param = param.replace("JWTR", "JWTRNS") if year == 2019 else param
+            for state, name in self.codes.select(pl.col("fips", "state_name")).rows():
+                url = f'{base}{year}{flow}?get={year_param}&for=state:{str(state).zfill(2)}&key={self.key}'
+                jobs.append((year, name, url))
 
-            acs = pl.DataFrame(empty_df).clear()
-            if year == 2019:
-                param = param.replace("JWTR", "JWTRNS")
+        def parse(rows: list, year: int) -> pl.DataFrame:
+            header = ["JWTR" if col == "JWTRNS" else col for col in rows[0]]
+            df = pl.DataFrame(rows[1:], schema={col: pl.String for col in header}, orient="row")
+            return df.with_columns(year=pl.lit(year)).select(
+                pl.col(col).cast(dtype) for col, dtype in schema.items())
 
-            for state, name in self.codes.select(pl.col("fips", "state_name")).rows():
-                url = f'{base}{year}{flow}?get={param}&for=state:{str(state).zfill(2)}&key={self.key}'
+        frames = {year: [] for year, _, _ in jobs}
+        remaining = {year: 0 for year in frames}
+        failed = {year: [] for year in frames}
+        for year, _, _ in jobs:
+            remaining[year] += 1
 
+        acs_api = DataDownload(workers=8, rate=10, debug=self.debug)
+        with ThreadPoolExecutor(max_workers=acs_api.workers) as executor:
+            futures = {executor.submit(acs_api.get_json, url): (year, name) for year, name, url in jobs}
+            for future in as_completed(futures):
+                year, name = futures[future]
                 try:
-                    r = requests.get(url).json()
-                    df = pl.DataFrame(r)
-                    names = df.select(pl.col("column_0")).transpose()
-                    df = df.drop("column_0").transpose()
-                    df = df.rename(names.to_dicts().pop()).with_columns(year=pl.lit(year))
-                    df = df.with_columns(pl.col("*").exclude("ADJHSG", "ADJINC").cast(pl.Int64))
-                    if year == 2019:
-                        df = df.rename({"JWTRNS": "JWTR"})
-                    acs = pl.concat([acs, df], how="vertical")
+                    rows = future.result()
+                    if rows:
+                        frames[year].append(parse(rows, year))
                     print("\033[0;32mINFO: \033[0m" + f"Downloaded ACS data for {name} {year}")
-
                 except RequestException as e:
                     print("\033[1;33mWARNING: \033[0m" + f"Could not download ACS data for {name} {year}: {e}")
-                    continue
+                    failed[year].append(name)
 
-            acs.write_parquet(f"data/raw/acs_{year}.parquet")
+                remaining[year] -= 1
+                if remaining[year] == 0:
+                    year_frames = frames.pop(year)
+                    if failed[year]:
+                        print("\033[1;33mWARNING: \033[0m" + f"Not writing ACS data for {year}, "
+                              f"{len(failed[year])} states failed")
+                        continue
+                    acs = pl.concat(year_frames, how="vertical") if year_frames else pl.DataFrame(schema=schema)
+                    acs.write_parquet(f"data/raw/acs_{year}.parquet")
+                    if self.debug:
+                        print("\033[0;32mINFO: \033[0m" + f"Finished downloading ACS data for {year}")
 
-            if self.debug:
-                print("\033[0;32mINFO: \033[0m" + f"Finished downloading ACS data for {year}")
+        missing = {year: names for year, names in failed.items() if names}
+        if missing:
+            raise RuntimeError("ACS downloads failed for " + ", ".join(
+                f"{year} ({', '.join(names)})" for year, names in sorted(missing.items())))
 
     def pull_file(self, url: str, filename: str) -> None:
         """
-        Downloads a file from a given URL and saves it locally.
+        Downloads a file from a given URL and saves it locally. A failed download is re-raised
+        so the calling pipeline stage is not recorded as done.
 
         Parameters
         ----------
@@ -203,17 +288,61 @@ class DataPull:
         filename : str
             The path to save the downloaded file.
         """
-        if os.path.exists(filename):
+        if not self.downloader.pending(filename, self.revalidate):
             if self.debug:
                 print("\033[0;36mNOTICE: \033[0m" + f"File {filename} already exists, skipping download")
         else:
             try:
-                urlretrieve(url, filename)
-                if self.debug:
+                if self.downloader.sync(url, filename, self.revalidate) and self.debug:
                     print("\033[0;32mINFO: \033[0m" + f"Downloaded {filename}")
-            except URLError:
-                if self.debug:
-                    print("\033[1;33mWARNING: \033[0m" + f"Could not download {filename}")
+                self.cache.save()
+            except RequestException:
+                print("\033[1;33mWARNING: \033[0m" + f"Could not download {filename}")
+                raise
+
+    def pull_files(self, jobs: list) -> dict:
+        """
+        Downloads many files concurrently, skipping those that already exist.
+
+        Parameters
+        ----------
+        jobs : list
+            A list of (url, filename) tuples.
+
+        Returns
+        -------
+        dict
+            Download statistics as returned by `DataDownload.fetch_all`.
+
+        Raises
+        ------
+        RuntimeError
+            If any download failed after all retries, so the calling pipeline stage is not
+            recorded as done and the missing files are retried on the next run. Files the
+            server does not have (4xx, e.g. counties that did not exist yet in a TIGER year)
+            do not fail the stage.
+        """
+        stats = self.downloader.fetch_all(jobs, self.revalidate)
+        if stats["failed"] > 0:
+            raise RuntimeError(f"{stats['failed']} of {len(jobs)} downloads failed")
+        return stats
+
+    def verify_cache(self, remove=False) -> list:
+        """
+        Checks every file in the download manifest against its recorded size and hash.
+
+        Parameters
+        ----------
+        remove : bool, optional
+            If True, deletes files that fail verification. The default is False.
+
+        Returns
+        -------
+        list
+            The paths of the files that failed verification and will be downloaded again.
+        """
+        return self.cache.verify(remove=remove)
 
 if __name__ == "__main__":
-    DataPull(debug=True)
+    from src.data.data_pipeline import DataPipeline
+    DataPipeline(debug=True).run(["pull_pumas", "pull_roads", "pull_acs", "pull_states"])
@@ -0,0 +1,328 @@
+from contextlib import contextmanager
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+import polars as pl
+import numpy as np
+import tempfile
+import hashlib
+import shapely
+import json
+import glob
+import os
+
+
+class DataStore:
+    """
+    Reads and writes the interim geometry files as GeoParquet with GeoArrow (native,
+    non-WKB) geometry encoding. Every file has a `bbox` covering column and is written
+    sorted by a key column with one or more row groups per key value, so readers can
+    prune by key or bounding box and project only the columns they need.
+
+    Also reads and writes the processed road lengths, stored as a hive-partitioned dataset
+    with one file per (year, state) under data/processed/roads, and simplifies the PUMA
+    geometries shared by the per-state GeoJSON files and the vector tiles.
+    """
+
+    roads_path = "data/processed/roads"
+    geojson_path = "data/processed/geojson"
+    # map zoom level -> (simplification tolerance, coordinate grid) in degrees
+    geojson_levels = {3: (0.01, 0.001), 6: (0.001, 0.0001), 9: (0.0001, 0.00001)}
+    roads_partitioning = pa.schema([("year", pa.int64()), ("state_id", pa.string())])
+    roads_schema = pa.schema([("year", pa.int64()), ("state_id", pa.string()),
+                              ("puma_id", pa.string()), ("length", pa.float64())])
+
+    encodings = {
+        shapely.GeometryType.POINT: "point",
+        shapely.GeometryType.LINESTRING: "linestring",
+        shapely.GeometryType.POLYGON: "polygon",
+        shapely.GeometryType.MULTIPOINT: "multipoint",
+        shapely.GeometryType.MULTILINESTRING: "multilinestring",
+        shapely.GeometryType.MULTIPOLYGON: "multipolygon",
+    }
+
+    @staticmethod
+    def encode(geoms: np.ndarray) -> tuple:
+        """
+        Encodes geometries as a GeoArrow nested list array of separated x/y coordinates.
+
+        Parameters
+        ----------
+        geoms : np.ndarray
+            Array of geometries of a single family (e.g. polygons and multipolygons).
+
+        Returns
+        -------
+        tuple
+            The GeoArrow encoding name and the encoded array.
+        """
+        geom_type, coords, offsets = shapely.to_ragged_array(geoms)
+        array = pa.StructArray.from_arrays([pa.array(coords[:, 0]), pa.array(coords[:, 1])], names=["x", "y"])
+        for offset in offsets:
+            array = pa.ListArray.from_arrays(pa.array(offset, type=pa.int32()), array)
+        return DataStore.encodings[geom_type], array
+
+    @staticmethod
+    def decode(array: pa.Array, encoding: str) -> np.ndarray:
+        """
+        Decodes a GeoArrow array written by `encode` back to shapely geometries.
+
+        Parameters
+        ----------
+        array : pa.Array
+            The encoded geometry column.
+        encoding : str
+            The GeoArrow encoding name recorded in the file metadata.
+
+        Returns
+        -------
+        np.ndarray
+            Array of geometries.
+        """
+        if isinstance(array, pa.ChunkedArray):
+            array = array.combine_chunks()
+        offsets = []
+        while isinstance(array, pa.ListArray):
+            offsets.append(array.offsets.to_numpy())
+            array = array.values
+        coords = np.column_stack([array.field("x").to_numpy(), array.field("y").to_numpy()])
+        geom_type = {name: kind for kind, name in DataStore.encodings.items()}[encoding]
+        return shapely.from_ragged_array(geom_type, coords, tuple(reversed(offsets)))
+
+    @staticmethod
+    @contextmanager
+    def atomic_write(path: str):
+        """
+        Yields a temporary path next to `path` to write a file to, and moves the file into place
+        once the block completes, so readers never see a partial file. The directory is created
+        if needed, and the temporary file is removed if the block fails.
+
+        Parameters
+        ----------
+        path : str
+            The file to write.
+
+        Yields
+        ------
+        str
+            The temporary path, on the same file system as `path`.
+        """
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".part")
+        os.close(fd)
+        try:
+            yield tmp
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    @staticmethod
+    def write_geoparquet(gdf: gpd.GeoDataFrame, path: str, sort_by: str, row_group_size=50_000) -> None:
+        """
+        Writes a GeoDataFrame to GeoParquet atomically.
+
+        Parameters
+        ----------
+        gdf : gpd.GeoDataFrame
+            The data to write. The geometry column must hold a single geometry family.
+        path : str
+            The destination file.
+        sort_by : str
+            The column rows are sorted and grouped by, e.g. the state identifier.
+        row_group_size : int, optional
+            Maximum number of rows per row group. The default is 50,000.
+        """
+        gdf = gdf.sort_values(sort_by, kind="stable").reset_index(drop=True)
+        geoms = gdf.geometry.to_numpy()
+        encoding, geometry = DataStore.encode(geoms)
+        bounds = shapely.bounds(geoms)
+        bbox = pa.StructArray.from_arrays([pa.array(bounds[:, i]) for i in range(4)],
+                                          names=["xmin", "ymin", "xmax", "ymax"])
+
+        table = pa.Table.from_pandas(pd.DataFrame(gdf.drop(columns=gdf.geometry.name)), preserve_index=False)
+        crs = gdf.crs.to_json_dict() if gdf.crs else None
+        field = pa.field("geometry", geometry.type, metadata={
+            "ARROW:extension:name": f"geoarrow.{encoding}",
+            "ARROW:extension:metadata": json.dumps({"crs": crs} if crs else {}),
+        })
+        table = table.append_column(field, geometry).append_column("bbox", bbox)
+        geo = {
+            "version": "1.1.0",
+            "primary_column": "geometry",
+            "columns": {"geometry": {
+                "encoding": encoding,
+                "geometry_types": sorted({geom.geom_type for geom in geoms if geom is not None}),
+                "crs": crs,
+                "bbox": [float(np.nanmin(bounds[:, 0])), float(np.nanmin(bounds[:, 1])),
+                         float(np.nanmax(bounds[:, 2])), float(np.nanmax(bounds[:, 3]))] if len(gdf) else [],
+                "covering": {"bbox": {
+                    "xmin": ["bbox", "xmin"], "ymin": ["bbox", "ymin"],
+                    "xmax": ["bbox", "xmax"], "ymax": ["bbox", "ymax"],
+                }},
+            }},
+        }
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"geo": json.dumps(geo).encode()})
+
+        keys = gdf[sort_by].to_numpy()
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.array([], dtype=int)
+        ends = np.r_[starts[1:], len(keys)]
+
+        with DataStore.atomic_write(path) as tmp, pq.ParquetWriter(tmp, table.schema) as writer:
+            for start, end in zip(starts, ends):
+                writer.write_table(table.slice(start, end - start), row_group_size=row_group_size)
+
+    @staticmethod
+    def read_geoparquet(path: str, columns=None, filters=None, bbox=None):
+        """
+        Reads a GeoParquet file written by `write_geoparquet`, loading only the requested
+        columns and the row groups that can match the filters.
+
+        Parameters
+        ----------
+        path : str
+            The file to read.
+        columns : list, optional
+            The columns to load. If None, every column except `bbox` is loaded. The default is None.
+        filters : list, optional
+            Row filters in pyarrow's DNF form, e.g. [("state_id", "in", ["06", "72"])]. The default is None.
+        bbox : tuple, optional
+            Only rows whose bounding box intersects (xmin, ymin, xmax, ymax) are loaded. The default is None.
+
+        Returns
+        -------
+        gpd.GeoDataFrame
+            The requested rows and columns, or a pd.DataFrame if the geometry was not requested.
+        """
+        dataset = ds.dataset(path, format="parquet")
+        geo = json.loads(dataset.schema.metadata[b"geo"])["columns"]["geometry"]
+        if columns is None:
+            columns = [name for name in dataset.schema.names if name != "bbox"]
+
+        expression = pq.filters_to_expression(filters) if filters else None
+        if bbox is not None:
+            xmin, ymin, xmax, ymax = bbox
+            overlap = ((ds.field("bbox", "xmax") >= xmin) & (ds.field("bbox", "xmin") <= xmax)
+                       & (ds.field("bbox", "ymax") >= ymin) & (ds.field("bbox", "ymin") <= ymax))
+            expression = overlap if expression is None else expression & overlap
+
+        table = dataset.to_table(columns=columns, filter=expression)
+        if "geometry" not in columns:
+            return table.to_pandas()
+        geoms = DataStore.decode(table.column("geometry"), geo["encoding"])
+        gdf = gpd.GeoDataFrame(table.drop_columns(["geometry"]).to_pandas(), geometry=geoms, crs=geo["crs"])
+        return gdf[columns]
+
+    @staticmethod
+    def road_partition(year: int, state_id: str) -> str:
+        """
+        Returns the path of the road length partition of a (year, state) pair.
+        """
+        return f"{DataStore.roads_path}/year={year}/state_id={str(state_id).zfill(2)}/part.parquet"
+
+    @staticmethod
+    def write_roads(df: pl.DataFrame) -> None:
+        """
+        Writes road lengths to their (year, state) partitions. Each partition is written to a
+        temporary file and moved into place, so a partition on disk is always complete.
+
+        Parameters
+        ----------
+        df : pl.DataFrame
+            Road lengths with columns year, state_id, puma_id and length.
+        """
+        for (year, state_id), part in df.group_by(["year", "state_id"]):
+            with DataStore.atomic_write(DataStore.road_partition(year, state_id)) as tmp:
+                part.select("puma_id", "length").write_parquet(tmp)
+
+    @staticmethod
+    def read_roads(years=None, states=None) -> pl.DataFrame:
+        """
+        Reads road lengths, opening only the partitions of the requested years and states.
+
+        Parameters
+        ----------
+        years : list, optional
+            The years to load. If None, every year is loaded. The default is None.
+        states : list, optional
+            The state identifiers to load. If None, every state is loaded. The default is None.
+
+        Returns
+        -------
+        pl.DataFrame
+            The road lengths with columns year, state_id, puma_id and length.
+        """
+        schema = {"year": pl.Int64, "state_id": pl.String, "puma_id": pl.String, "length": pl.Float64}
+        if not os.path.exists(DataStore.roads_path):
+            return pl.DataFrame(schema=schema)
+        # an explicit schema, since partition directories left without files give no columns to infer
+        dataset = ds.dataset(DataStore.roads_path, format="parquet", schema=DataStore.roads_schema,
+                             partitioning=ds.partitioning(DataStore.roads_partitioning, flavor="hive"),
+                             exclude_invalid_files=False, ignore_prefixes=[".", "_"])
+        expression = None
+        if years is not None:
+            expression = ds.field("year").isin([int(year) for year in years])
+        if states is not None:
+            in_states = ds.field("state_id").isin([str(state).zfill(2) for state in states])
+            expression = in_states if expression is None else expression & in_states
+        table = dataset.to_table(columns=list(schema), filter=expression)
+        return pl.from_arrow(table).cast(schema)
+
+    @staticmethod
+    def simplify(geoms: np.ndarray, tolerance: float, grid: float) -> np.ndarray:
+        """
+        Simplify a set of adjacent polygons and snap their coordinates to a grid. The polygons
+        are simplified as one coverage, so every shared border is simplified once and the
+        neighbors still meet along it without gaps or slivers.
+
+        Parameters
+        ----------
+        geoms : np.ndarray
+            Array of polygon geometries.
+        tolerance : float
+            The simplification tolerance.
+        grid : float
+            The size of the grid coordinates are snapped to.
+
+        Returns
+        -------
+        np.ndarray
+            The simplified geometries, in the order of `geoms`.
+        """
+        return shapely.set_precision(shapely.coverage_simplify(geoms, tolerance), grid)
+
+    @staticmethod
+    def geojson_file(state_id: str, zoom: int) -> str:
+        """
+        Returns the path of the simplified GeoJSON of a state for the closest prebuilt zoom
+        level at or below `zoom`.
+        """
+        level = max([level for level in DataStore.geojson_levels if level <= zoom] or [min(DataStore.geojson_levels)])
+        return f"{DataStore.geojson_path}/{str(state_id).zfill(2)}_{level}.json"
+
+    @staticmethod
+    def fingerprint(patterns: list) -> str:
+        """
+        Fingerprints the files matching the given glob patterns by path, size and modification time.
+
+        Parameters
+        ----------
+        patterns : list
+            Glob patterns to fingerprint.
+
+        Returns
+        -------
+        str
+            A hex digest that changes whenever a matching file is added, removed or modified.
+        """
+        digest = hashlib.sha256()
+        for pattern in patterns:
+            digest.update(pattern.encode())
+            for path in sorted(glob.glob(pattern, recursive=True)):
+                stat = os.stat(path)
+                digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return digest.hexdigest()
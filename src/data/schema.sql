@@ -1,5 +1,5 @@
 -- add postgis extension
-CREATE EXTENSION IF NOT EXISTS postgis;
+CREATE EXTENSION IF NOT EXISTS postgis SCHEMA public;
 
 -- create the spatial tables
 CREATE TABLE IF NOT EXISTS "states_shp"(
@@ -33,6 +33,12 @@ CREATE TABLE IF NOT EXISTS "counts_shp"(
     PRIMARY KEY ("count_id")
 );
 
+-- number blocks and pumas as they are loaded
+CREATE SEQUENCE IF NOT EXISTS "blocks_shp_block_id_seq" OWNED BY "blocks_shp"."block_id";
+ALTER TABLE "blocks_shp" ALTER COLUMN "block_id" SET DEFAULT nextval('blocks_shp_block_id_seq');
+CREATE SEQUENCE IF NOT EXISTS "pumas_shp_puma_id_seq" OWNED BY "pumas_shp"."puma_id";
+ALTER TABLE "pumas_shp" ALTER COLUMN "puma_id" SET DEFAULT nextval('pumas_shp_puma_id_seq');
+
 -- create demographic tables
 CREATE TABLE IF NOT EXISTS "sex_table"(
     "sex_id" SERIAL PRIMARY KEY,
@@ -64,6 +70,17 @@ CREATE TABLE IF NOT EXISTS "acs_table"(
     "race_id" TEXT NOT NULL
 );
 
+-- record the files loaded into every table
+CREATE TABLE IF NOT EXISTS "load_ledger"(
+    "table_name" TEXT NOT NULL,
+    "source" TEXT NOT NULL,
+    "sha256" CHAR(64) NOT NULL,
+    "rows" BIGINT NOT NULL,
+    "status" TEXT NOT NULL,
+    "loaded_at" TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY ("table_name", "source")
+);
+
 -- create hypertables
 
 SELECT create_hypertable(
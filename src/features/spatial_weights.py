@@ -0,0 +1,233 @@
+from src.data.data_cache import DataCache
+from src.data.data_store import DataStore
+from functools import cached_property
+from scipy.spatial import cKDTree
+from scipy import sparse
+import numpy as np
+import shapely
+import glob
+import os
+
+
+class SpatialWeights:
+    """
+    Builds the Queen, Rook and KNN spatial weights of the PUMAs once and caches them as
+    sparse CSR matrices together with their ID order. Cached weights are keyed by the SHA-256
+    digest of the PUMA geometry file, so they are only rebuilt when the geometries change.
+
+    Contiguity is found by hashing the polygon vertices (Queen) or edges (Rook) and pairing
+    the PUMAs that share one, which is linear in the number of vertices instead of testing
+    polygons against each other.
+
+    Parameters
+    ----------
+    path : str, optional
+        The PUMA GeoParquet file. The default is "data/interim/pumas.parquet".
+    cache : str, optional
+        The directory of the cached weights. The default is "data/processed/weights".
+    debug : bool, optional
+        If True, enables debug messages. The default is False.
+    """
+
+    kinds = ["queen", "rook", "knn"]
+
+    def __init__(self, path="data/interim/pumas.parquet", cache="data/processed/weights", debug=False):
+        """
+        Initializes the SpatialWeights class.
+        """
+        self.path = path
+        self.cache = cache
+        self.debug = debug
+
+    @cached_property
+    def digest(self) -> str:
+        """
+        The SHA-256 digest of the PUMA geometry file.
+        """
+        return DataCache.sha256(self.path)
+
+    def file(self, kind: str, k=4) -> str:
+        """
+        Returns the path of the cached weights of a kind for the current geometry file.
+        """
+        name = f"knn{k}" if kind == "knn" else kind
+        return f"{self.cache}/{name}_{self.digest[:16]}.npz"
+
+    def load(self, kind="queen", k=4) -> tuple:
+        """
+        Loads spatial weights from the cache, building and caching them first if needed.
+
+        Parameters
+        ----------
+        kind : str, optional
+            One of "queen", "rook" or "knn". The default is "queen".
+        k : int, optional
+            The number of neighbors of KNN weights. The default is 4.
+
+        Returns
+        -------
+        tuple
+            The binary weights as a sparse CSR matrix and the PUMA IDs of its rows, sorted by ID.
+        """
+        if kind not in self.kinds:
+            raise ValueError(f"Unknown weights {kind}, expected one of {', '.join(self.kinds)}")
+        path = self.file(kind, k)
+        if os.path.exists(path):
+            with np.load(path, allow_pickle=False) as npz:
+                matrix = sparse.csr_matrix((npz["data"], npz["indices"], npz["indptr"]), shape=tuple(npz["shape"]))
+                return matrix, npz["ids"]
+
+        puma = DataStore.read_geoparquet(self.path, columns=["puma_id", "geometry"])
+        puma = puma.sort_values("puma_id").reset_index(drop=True)
+        geoms = puma.geometry.to_numpy()
+        if kind == "knn":
+            matrix = self.knn(geoms, k)
+        else:
+            matrix = self.contiguity(geoms, rook=kind == "rook")
+        ids = puma["puma_id"].astype(str).to_numpy()
+        self.save(path, matrix, ids)
+        if self.debug:
+            print("\033[0;36mINFO: \033[0m" + f"Built {kind} weights of {len(ids)} PUMAs "
+                  f"with {matrix.nnz / max(len(ids), 1):.2f} neighbors on average")
+        return matrix, ids
+
+    def save(self, path: str, matrix: sparse.csr_matrix, ids: np.ndarray) -> None:
+        """
+        Writes weights to the cache atomically and removes the weights of the same kind that
+        were built from other geometry files.
+        """
+        with DataStore.atomic_write(path) as tmp, open(tmp, "wb") as file:
+            np.savez(file, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                     shape=np.array(matrix.shape), ids=ids.astype(str))
+        for stale in glob.glob(f"{path.rsplit('_', 1)[0]}_*.npz"):
+            if stale != path:
+                os.remove(stale)
+
+    @staticmethod
+    def pairs(keys: np.ndarray, owners: np.ndarray, n: int) -> sparse.csr_matrix:
+        """
+        Builds the symmetric binary matrix linking every two owners that share a key.
+
+        Parameters
+        ----------
+        keys : np.ndarray
+            Integer keys, e.g. vertex or edge IDs.
+        owners : np.ndarray
+            The index of the polygon each key belongs to.
+        n : int
+            The number of polygons.
+
+        Returns
+        -------
+        sparse.csr_matrix
+            The n x n binary weights.
+        """
+        order = np.lexsort((owners, keys))
+        keys, owners = keys[order], owners[order]
+        unique = np.r_[True, (keys[1:] != keys[:-1]) | (owners[1:] != owners[:-1])]
+        keys, owners = keys[unique], owners[unique]
+
+        # keys are sorted, so the owners of a key are contiguous: pair each owner with the
+        # next ones in its run until no run is that long
+        rows, cols = [], []
+        for step in range(1, len(keys)):
+            same = keys[step:] == keys[:-step]
+            if not same.any():
+                break
+            rows.append(owners[:-step][same])
+            cols.append(owners[step:][same])
+        rows = np.concatenate(rows) if rows else np.array([], dtype=np.int64)
+        cols = np.concatenate(cols) if cols else np.array([], dtype=np.int64)
+
+        matrix = sparse.csr_matrix((np.ones(2 * len(rows)), (np.r_[rows, cols], np.r_[cols, rows])), shape=(n, n))
+        matrix.sum_duplicates()
+        matrix.data[:] = 1.0
+        return matrix
+
+    @staticmethod
+    def contiguity(geoms: np.ndarray, rook=False) -> sparse.csr_matrix:
+        """
+        Builds Queen (shared vertex) or Rook (shared edge) contiguity weights.
+
+        Parameters
+        ----------
+        geoms : np.ndarray
+            Array of polygons and multipolygons.
+        rook : bool, optional
+            If True, polygons must share an edge instead of a single vertex. The default is False.
+
+        Returns
+        -------
+        sparse.csr_matrix
+            The binary contiguity weights in the order of `geoms`.
+        """
+        parts, part_owner = shapely.get_parts(geoms, return_index=True)
+        rings, ring_part = shapely.get_rings(parts, return_index=True)
+        coords, ring = shapely.get_coordinates(rings, return_index=True)
+        owners = part_owner[ring_part][ring]
+        _, vertex = np.unique(coords, axis=0, return_inverse=True)
+        vertex = vertex.ravel().astype(np.int64)
+        if not rook:
+            return SpatialWeights.pairs(vertex, owners, len(geoms))
+
+        # an edge is the unordered pair of consecutive vertices of a ring
+        same = ring[1:] == ring[:-1]
+        start, end = vertex[:-1][same], vertex[1:][same]
+        edge = np.minimum(start, end) * (vertex.max() + 1) + np.maximum(start, end)
+        return SpatialWeights.pairs(edge, owners[:-1][same], len(geoms))
+
+    @staticmethod
+    def knn(geoms: np.ndarray, k=4) -> sparse.csr_matrix:
+        """
+        Builds k-nearest-neighbor weights between polygon centroids.
+
+        Parameters
+        ----------
+        geoms : np.ndarray
+            Array of polygons and multipolygons.
+        k : int, optional
+            The number of neighbors. The default is 4.
+
+        Returns
+        -------
+        sparse.csr_matrix
+            The binary, row-wise KNN weights in the order of `geoms`.
+        """
+        points = shapely.get_coordinates(shapely.centroid(geoms))
+        k = min(k, len(points) - 1)
+        _, neighbors = cKDTree(points).query(points, k=k + 1)
+        rows = np.repeat(np.arange(len(points)), k)
+        # drop each point itself, which is not always the first match when centroids coincide
+        cols = np.array([[j for j in row if j != i][:k] for i, row in enumerate(neighbors)]).ravel()
+        return sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(points), len(points)))
+
+    def build(self) -> None:
+        """
+        Builds and caches every kind of weights of the current geometry file.
+        """
+        for kind in self.kinds:
+            self.load(kind)
+
+    def to_w(self, kind="queen", k=4):
+        """
+        Returns cached spatial weights as a libpysal W, e.g. for spreg models.
+
+        Parameters
+        ----------
+        kind : str, optional
+            One of "queen", "rook" or "knn". The default is "queen".
+        k : int, optional
+            The number of neighbors of KNN weights. The default is 4.
+
+        Returns
+        -------
+        libpysal.weights.W
+            The weights, with the PUMA IDs as ids in sorted order.
+        """
+        from libpysal.weights import WSP
+        matrix, ids = self.load(kind, k)
+        return WSP(matrix, id_order=ids.tolist()).to_W(silence_warnings=True)
+
+
+if __name__ == "__main__":
+    SpatialWeights(debug=True).build()
@@ -1,6 +1,14 @@
+from src.data.data_store import DataStore
+import plotly.graph_objects as go
 import plotly.express as px
 import geopandas as gpd
 import pandas as pd
+import pyarrow as pa
+import numpy as np
+import threading
+import sqlite3
+import time
+import os
 
 class DataGraph:
     """
@@ -10,56 +18,265 @@ class DataGraph:
     Attributes
     ----------
     puma : gpd.GeoDataFrame
-        A GeoDataFrame containing PUMA boundaries and IDs.
-    data : gpd.GeoDataFrame
-        A GeoDataFrame containing ACS data merged with PUMA boundaries.
+        A GeoDataFrame containing PUMA boundaries indexed by PUMA ID. None in lazy mode.
+    data : pd.DataFrame
+        A DataFrame containing ACS and road data without geometries, sorted by state, sex, race and year.
+        In lazy mode, a memory-mapped pa.Table with the same columns. None with a database.
+    index : dict
+        The (start, stop) row range of every (state, sex, race, year) and (state, sex, race) group of `data`.
+    timings : dict
+        The seconds spent in each step of the startup.
+
+    Parameters
+    ----------
+    lazy : bool, optional
+        If True, the attribute table is memory-mapped from an Arrow IPC snapshot, so every
+        worker on the host shares the same pages, and PUMA geometries are read per state on
+        first use. The snapshot is rebuilt when the data changes. The default is False.
+    snapshot : str, optional
+        Location of the Arrow IPC snapshot. The default is "data/processed/graph.arrow".
+    database : str, optional
+        Location of an SQLite database holding the ACS and road tables, indexed by (state, sex,
+        race, year). If given, `graph` filters and joins the rows inside the database instead
+        of holding the attribute table in memory, and PUMA geometries are read per state as in
+        lazy mode. The database is rebuilt when the data changes. The default is None.
     """
 
-    def __init__(self):
+    # the travel modes offered by the app
+    modes = ["car", "bus", "streetcar", "subway", "railroad", "ferry", "taxi", "motorcycle", "bicycle", "walking"]
+    # seconds `version` reuses its fingerprint before checking the data files again
+    version_ttl = 30
+
+    def __init__(self, lazy=False, snapshot="data/processed/graph.arrow", database=None):
         """
         Initializes the DataGraph class by loading PUMA boundaries and ACS data.
         """
-        self.puma = self.load_puma()
-        self.data = self.load_data()
+        self.lazy = lazy
+        self.snapshot = snapshot
+        self.database = database
+        self.timings = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.states = {}
+        self.national = {}
+        self.checked = (-float("inf"), None)
+        if database:
+            self.puma = None
+            self.data = None
+            self.timed("database", self.load_database)
+        elif lazy:
+            self.puma = None
+            self.data = self.timed("snapshot", self.load_snapshot)
+            keys = self.timed("keys", lambda: self.data.select(["state", "sex", "race", "year"]).to_pandas())
+        else:
+            self.puma = self.timed("puma", self.load_puma)
+            self.data = self.timed("data", self.load_data)
+            keys = self.data
+        if database:
+            self.index = self.timed("index", self.database_index)
+        else:
+            self.index = self.timed("index", self.build_index, keys)
+
+    def timed(self, step: str, func, *args):
+        """
+        Runs a startup step and records its wall-clock time in `timings`.
+        """
+        start = time.perf_counter()
+        result = func(*args)
+        self.timings[step] = time.perf_counter() - start
+        return result
 
     def load_puma(self) -> gpd.GeoDataFrame:
         """
-        Loads PUMA boundaries from a GeoPackage file and processes them.
+        Loads PUMA boundaries from the interim GeoParquet file and processes them. Every
+        PUMA geometry is held once, keyed by its ID, and joined to the data only at render time.
 
         Returns
         -------
         gpd.GeoDataFrame
-            A GeoDataFrame containing PUMA IDs and geometries.
+            A GeoDataFrame of PUMA geometries indexed by PUMA ID.
         """
-        puma = gpd.read_file('data/interim/pumas.gpkg', engine="pyogrio")
+        puma = DataStore.read_geoparquet("data/interim/pumas.parquet", columns=["puma_id", "geometry"])
         puma["puma_id"] = puma["puma_id"].astype(str).str.zfill(6)
-        return puma[["puma_id", "geometry"]].copy()
-    
-    def load_data(self) -> gpd.GeoDataFrame:
+        return puma[["puma_id", "geometry"]].set_index("puma_id")
+
+    def load_data(self, puma_ids=None) -> pd.DataFrame:
         """
-        Loads ACS data from a parquet file, filters it for the year 2019, and merges it with PUMA boundaries.
+        Loads ACS data from a parquet file and merges it with the road lengths into a compact
+        attribute table: categorical race and PUMA ID, small integer keys and float32 measures.
+        Rows without a PUMA geometry are dropped.
+
+        Parameters
+        ----------
+        puma_ids : pd.Index, optional
+            The PUMA IDs that have a geometry. The default is the index of `puma`.
 
         Returns
         -------
-        gpd.GeoDataFrame
-            A GeoDataFrame containing filtered ACS data with geometries.
+        pd.DataFrame
+            A DataFrame containing the ACS and road data, without geometries.
         """
-        df_roads = pd.read_parquet("data/processed/roads.parquet")
+        df_roads = DataStore.read_roads().to_pandas()
         df_acs = pd.read_parquet("data/processed/acs.parquet")
         df_acs["puma_id"] = df_acs["state"].astype(str).str.zfill(2) + df_acs["PUMA"].astype(str).str.zfill(5)
         # df['year'] = pd.to_datetime(df['year'], format='%Y-%m-%d')  # Uncomment if needed
         master_df = df_acs.merge(df_roads, on=["puma_id", "year"], how="left")
-        master_df = master_df.sort_values(by=["year", "puma_id"], ascending=True).reset_index(drop=True)
         master_df["length"] = master_df["length"] / 1000
         master_df[['car', 'bus','streetcar', 'subway', 'railroad', 'ferry', 'taxi','motorcycle','bicycle', 'walking']] = master_df[['car', 'bus','streetcar', 'subway', 'railroad', 'ferry', 'taxi','motorcycle','bicycle', 'walking']] / 1000
-        df = master_df.copy()
-        df["puma_id"] = df["state"].astype(str).str.zfill(2) + df["PUMA"].astype(str).str.zfill(5)
-        df = df.merge(self.puma, on="puma_id", how="inner")
-        return gpd.GeoDataFrame(df, geometry=df["geometry"], crs=3857)
+        df = master_df[master_df["puma_id"].isin(self.puma.index if puma_ids is None else puma_ids)]
+        df = df.sort_values(by=["state", "sex", "race", "year", "puma_id"], kind="stable").reset_index(drop=True)
 
-    def graph(self, state: str, sex: str, race: str) -> gpd.GeoDataFrame:
+        return self.compact(df)
+
+    def load_snapshot(self) -> pa.Table:
         """
-        Filters the data based on state, sex, and race, and returns the filtered GeoDataFrame.
+        Memory-maps the attribute table from its Arrow IPC snapshot, first rebuilding the
+        snapshot with `load_data` if it is missing or was built from other data.
+
+        Returns
+        -------
+        pa.Table
+            The attribute table, backed by the memory-mapped file.
+        """
+        version = self.version().encode()
+        current = None
+        if os.path.exists(self.snapshot):
+            current = (pa.ipc.open_file(pa.memory_map(self.snapshot)).schema.metadata or {}).get(b"version")
+        if current != version:
+            puma_ids = DataStore.read_geoparquet("data/interim/pumas.parquet", columns=["puma_id"])["puma_id"]
+            table = pa.Table.from_pandas(self.load_data(pd.Index(puma_ids.astype(str).str.zfill(6))), preserve_index=False)
+            table = table.replace_schema_metadata({**table.schema.metadata, b"version": version})
+            with DataStore.atomic_write(self.snapshot) as tmp, open(tmp, "wb") as sink, \
+                    pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        return pa.ipc.open_file(pa.memory_map(self.snapshot)).read_all()
+
+    def load_database(self) -> None:
+        """
+        Builds the SQLite database from the processed ACS data and road lengths if it is
+        missing or was built from other data. ACS rows are stored sorted by state, sex, race,
+        year and PUMA with a composite index on those columns, and road lengths are kept in
+        their own table keyed by PUMA and year, so `graph` joins only the rows it returns.
+        """
+        version = self.version()
+        if os.path.exists(self.database):
+            conn = sqlite3.connect(f"file:{self.database}?mode=ro", uri=True)
+            try:
+                current = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+            except sqlite3.DatabaseError:
+                current = None
+            finally:
+                conn.close()
+            if current == (version,):
+                return
+
+        puma_ids = DataStore.read_geoparquet("data/interim/pumas.parquet", columns=["puma_id"])["puma_id"]
+        df_acs = pd.read_parquet("data/processed/acs.parquet")
+        df_acs["puma_id"] = df_acs["state"].astype(str).str.zfill(2) + df_acs["PUMA"].astype(str).str.zfill(5)
+        df_acs = df_acs[df_acs["puma_id"].isin(puma_ids.astype(str).str.zfill(6))]
+        df_acs[self.modes] = df_acs[self.modes] / 1000
+        df_acs = df_acs.drop(columns=["state_id"], errors="ignore")
+        df_acs = df_acs.sort_values(by=["state", "sex", "race", "year", "puma_id"], kind="stable")
+        df_roads = DataStore.read_roads().to_pandas()[["year", "puma_id", "length"]]
+        df_roads["length"] = df_roads["length"] / 1000
+
+        with DataStore.atomic_write(self.database) as tmp:
+            with sqlite3.connect(tmp) as conn:
+                df_acs.to_sql("acs", conn, index=False, chunksize=50_000)
+                df_roads.to_sql("roads", conn, index=False, chunksize=50_000)
+                conn.execute("CREATE INDEX acs_keys ON acs (state, sex, race, year, puma_id)")
+                conn.execute("CREATE UNIQUE INDEX roads_keys ON roads (puma_id, year)")
+                conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+                conn.execute("INSERT INTO meta VALUES ('version', ?)", (version,))
+                conn.execute("ANALYZE")
+            conn.close()
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        Returns the read-only connection of the current thread to the SQLite database.
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.database}?mode=ro", uri=True)
+            self.local.conn = conn
+        return conn
+
+    def database_index(self) -> dict:
+        """
+        Builds the row ranges of every group from the SQLite database. The ACS rows are stored
+        in sorted order, so the ranges match those of `build_index` on the in-memory table.
+        """
+        index = {}
+        for columns in (["state", "sex", "race", "year"], ["state", "sex", "race"]):
+            query = f"SELECT {', '.join(columns)}, min(rowid) - 1, max(rowid) FROM acs GROUP BY {', '.join(columns)}"
+            for row in self.connection().execute(query):
+                key = tuple(int(value) if column != "race" else str(value) for column, value in zip(columns, row))
+                index[key] = (int(row[-2]), int(row[-1]))
+        return index
+
+    @staticmethod
+    def compact(df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Casts the attribute table to its compact dtypes: categorical race and PUMA ID, small
+        integer keys and float32 measures.
+        """
+        measures = df.columns.difference(["year", "state", "state_id", "PUMA", "puma_id", "sex", "race"])
+        df = df.astype({
+            "year": "int16",
+            "state": "int8",
+            "PUMA": "int32",
+            "sex": "int8",
+            "race": "category",
+            "puma_id": "category",
+            **{column: "float32" for column in measures},
+        })
+        return df.drop(columns=["state_id"], errors="ignore")
+
+    def geometries(self, state: str) -> gpd.GeoSeries:
+        """
+        Returns the PUMA geometries of a state indexed by PUMA ID. In lazy mode they are read
+        from the interim GeoParquet file the first time the state is requested.
+        """
+        if self.puma is not None:
+            return self.puma.geometry
+        with self.lock:
+            if state not in self.states:
+                puma = DataStore.read_geoparquet("data/interim/pumas.parquet", columns=["puma_id", "geometry"],
+                                                 filters=[("state_id", "==", str(state).zfill(2))])
+                puma["puma_id"] = puma["puma_id"].astype(str).str.zfill(6)
+                self.states[state] = puma.set_index("puma_id").geometry
+            return self.states[state]
+
+    def build_index(self, keys: pd.DataFrame) -> dict:
+        """
+        Builds the row ranges of every group of the sorted data, so a lookup is a dict access
+        and a slice instead of a scan of the whole table.
+
+        Parameters
+        ----------
+        keys : pd.DataFrame
+            The state, sex, race and year columns of the sorted data.
+
+        Returns
+        -------
+        dict
+            Maps (state, sex, race, year) and (state, sex, race) to a (start, stop) row range.
+        """
+        index = {}
+        for columns in (["state", "sex", "race", "year"], ["state", "sex", "race"]):
+            group = keys[columns]
+            starts = np.flatnonzero((group != group.shift()).any(axis=1).to_numpy())
+            stops = np.append(starts[1:], len(group))
+            for key, start, stop in zip(group.iloc[starts].itertuples(index=False, name=None), starts, stops):
+                index[key] = (int(start), int(stop))
+        return index
+
+    def graph(self, state: str, sex: str, race: str, year=None, geometry=True) -> gpd.GeoDataFrame:
+        """
+        Filters the data based on state, sex, race and optionally year, and returns the filtered
+        GeoDataFrame. The rows are located through the precomputed index as a slice of the
+        sorted data, and only their PUMA geometries are joined, so the cost does not depend
+        on the size of the table.
 
         Parameters
         ----------
@@ -69,12 +286,221 @@ class DataGraph:
             The sex to filter the data.
         race : str
             The race to filter the data.
+        year : int, optional
+            The year to filter the data. If None, every year is returned. The default is None.
+        geometry : bool, optional
+            If False, the PUMA geometries are not joined and a plain DataFrame is returned,
+            e.g. when the map references the prebuilt GeoJSON instead. The default is True.
 
         Returns
         -------
         gpd.GeoDataFrame
             A GeoDataFrame containing filtered data based on the specified criteria.
         """
-        gdf = self.data.copy()
-        gdf = gdf[(gdf["state"] == state) & (gdf["sex"] == sex) & (gdf["race"] == race)]
-        return gdf
+        key = (int(state), int(sex), str(race))
+        if year is not None:
+            key += (int(year),)
+        start, stop = self.index.get(key, (0, 0))
+        if self.database:
+            where = " AND ".join(f"a.{column} = ?" for column in ["state", "sex", "race", "year"][:len(key)])
+            rows = pd.read_sql_query(
+                f"SELECT a.*, r.length FROM acs AS a LEFT JOIN roads AS r ON r.puma_id = a.puma_id AND r.year = a.year "
+                f"WHERE {where} ORDER BY a.year, a.puma_id", self.connection(), params=key)
+            rows = self.compact(rows)
+            rows.index = pd.RangeIndex(start, start + len(rows))
+        elif self.lazy:
+            rows = self.data.slice(start, stop - start).to_pandas()
+            rows.index = pd.RangeIndex(start, stop)
+        else:
+            rows = self.data.iloc[start:stop]
+        if not geometry:
+            return rows
+        geoms = self.geometries(state).reindex(rows["puma_id"].astype(str)).to_numpy()
+        return gpd.GeoDataFrame(rows, geometry=geoms, crs=3857)
+
+    def geojson_url(self, state: str, zoom: int) -> str:
+        """
+        Returns the URL of the prebuilt simplified GeoJSON of a state, or None if it was not built.
+        The URL carries the data version, since browsers cache the file for a day.
+
+        Parameters
+        ----------
+        state : str
+            The state FIPS code.
+        zoom : int
+            The zoom level of the map.
+
+        Returns
+        -------
+        str
+            The URL served by the app, relative to its root.
+        """
+        path = DataStore.geojson_file(state, zoom)
+        if not os.path.exists(path):
+            return None
+        return "/" + os.path.relpath(path, "data/processed").replace(os.sep, "/") + f"?v={self.version()[:16]}"
+
+    def figure(self, state: str, sex: str, race: str, mode: str, year: int, zoom=3, origin="") -> go.Figure:
+        """
+        Builds the choropleth of a travel mode for one state, sex, race and year. State 0
+        is the national view, drawn from vector tiles instead of embedded polygons.
+
+        Parameters
+        ----------
+        state : str
+            The state FIPS code, or 0 for the whole country.
+        sex : str
+            The sex to filter the data.
+        race : str
+            The race to filter the data.
+        mode : str
+            The travel mode column to color the map by.
+        year : int
+            The year to filter the data.
+        zoom : int, optional
+            The initial zoom level of the map. The default is 3.
+        origin : str, optional
+            The scheme and host the vector tiles are served from. The default is "".
+
+        Returns
+        -------
+        go.Figure
+            The choropleth figure.
+        """
+        if int(state) == 0:
+            return self.national_figure(sex, race, mode, year, zoom, origin)
+        url = self.geojson_url(state, zoom)
+        if url is None:
+            df = self.graph(state, sex, race, year).astype({"puma_id": str})
+            geojson, locations, featureidkey = df.set_index("puma_id").geometry, "puma_id", "id"
+        else:
+            # the browser fetches the cached geometry once; only the values travel with each figure
+            df = self.graph(state, sex, race, year, geometry=False)[["puma_id", mode]].astype({"puma_id": str})
+            geojson, locations, featureidkey = url, "puma_id", "properties.puma_id"
+
+        fig = px.choropleth_mapbox(df,
+                                   geojson=geojson,
+                                   locations=locations,
+                                   featureidkey=featureidkey,
+                                   color=mode,
+                                   center={"lat": 37.0902, "lon": -95.7129},
+                                   mapbox_style="carto-positron",
+                                   color_continuous_scale="Viridis",
+                                   zoom=zoom)
+        return fig
+
+    def payload(self, state: str, sex: str, race: str) -> dict:
+        """
+        Builds the compact values of a state, sex and race sent to the browser once, so the
+        year slider and the mode dropdown can recolor the map without a server round-trip.
+
+        Parameters
+        ----------
+        state : str
+            The state FIPS code.
+        sex : str
+            The sex to filter the data.
+        race : str
+            The race to filter the data.
+
+        Returns
+        -------
+        dict
+            The PUMA IDs, the years and, for every travel mode, a dense year x PUMA matrix of
+            values with None where a PUMA has no data.
+        """
+        rows = self.graph(state, sex, race, geometry=False).astype({"puma_id": str})
+        puma_ids = sorted(rows["puma_id"].unique())
+        years = sorted(int(year) for year in rows["year"].unique())
+        values = {}
+        for mode in self.modes:
+            matrix = rows.pivot(index="year", columns="puma_id", values=mode).reindex(index=years, columns=puma_ids)
+            matrix = matrix.astype(float).round(6)
+            values[mode] = matrix.astype(object).where(matrix.notna(), None).to_numpy().tolist()
+        return {"puma_ids": puma_ids, "years": years, "values": values}
+
+    def bins(self, sex: str, race: str, mode: str, year: int, bins=7) -> tuple:
+        """
+        Splits the PUMAs of the whole country into quantile bins of a travel mode.
+
+        Parameters
+        ----------
+        sex : str
+            The sex to filter the data.
+        race : str
+            The race to filter the data.
+        mode : str
+            The travel mode column to bin.
+        year : int
+            The year to filter the data.
+        bins : int, optional
+            The number of bins. The default is 7.
+
+        Returns
+        -------
+        tuple
+            The bin edges and, for every bin, the set of its PUMA IDs.
+        """
+        version = self.version()
+        key = (version, int(sex), str(race), str(mode), int(year), bins)
+        with self.lock:
+            if key in self.national:
+                return self.national[key]
+        states = sorted({group[0] for group in self.index if len(group) == 4})
+        frames = [self.graph(state, sex, race, year, geometry=False)[["puma_id", mode]] for state in states]
+        df = pd.concat(frames) if frames else pd.DataFrame(columns=["puma_id", mode])
+        df = df[df[mode].notna()]
+        values = df[mode].to_numpy(dtype=float)
+        edges = np.unique(np.quantile(values, np.linspace(0, 1, bins + 1))) if len(values) else np.array([0.0, 0.0])
+        labels = np.clip(np.searchsorted(edges, values, side="right") - 1, 0, max(len(edges) - 2, 0))
+        ids = df["puma_id"].astype(str).to_numpy()
+        result = (edges, [set(ids[labels == i]) for i in range(max(len(edges) - 1, 1))])
+        with self.lock:
+            # bins of older data are never asked for again
+            self.national = {cached: value for cached, value in self.national.items() if cached[0] == version}
+            self.national[key] = result
+        return result
+
+    def national_figure(self, sex: str, race: str, mode: str, year: int, zoom=3, origin="") -> go.Figure:
+        """
+        Builds the national map of a travel mode as one vector tile layer per quantile bin,
+        so the browser only downloads the tiles in view and the figure holds no geometry.
+        """
+        edges, groups = self.bins(sex, race, mode, year)
+        version = self.version()[:12]
+        colors = px.colors.sample_colorscale("Viridis", [i / max(len(groups) - 1, 1) for i in range(len(groups))])
+        layers = [{
+            "sourcetype": "vector",
+            "sourcelayer": "pumas",
+            "source": [f"{origin}/tiles/{sex}/{race}/{mode}/{year}/{i}/{{z}}/{{x}}/{{y}}.pbf?v={version}"],
+            "type": "fill",
+            "color": color,
+            "opacity": 0.8,
+            "below": "traces",
+        } for i, color in enumerate(colors)]
+
+        n = len(groups)
+        colorscale = [[position, color] for i, color in enumerate(colors) for position in (i / n, (i + 1) / n)]
+        fig = go.Figure(go.Scattermapbox(
+            lat=[None, None], lon=[None, None], mode="markers", hoverinfo="skip", showlegend=False,
+            marker={"color": [0, n], "cmin": 0, "cmax": n, "colorscale": colorscale, "showscale": True,
+                    "colorbar": {"title": mode, "tickvals": list(range(len(edges))),
+                                 "ticktext": [f"{edge:.3g}" for edge in edges]}},
+        ))
+        fig.update_layout(mapbox={"style": "carto-positron", "center": {"lat": 37.0902, "lon": -95.7129},
+                                  "zoom": zoom, "layers": layers},
+                          margin={"l": 0, "r": 0, "t": 0, "b": 0})
+        return fig
+
+    def version(self) -> str:
+        """
+        Fingerprints the files the figures are built from, so cached figures are dropped after a data refresh.
+        The fingerprint is reused for `version_ttl` seconds, since every map and tile request asks for it.
+        """
+        checked, version = self.checked
+        if time.monotonic() - checked < self.version_ttl:
+            return version
+        version = DataStore.fingerprint(["data/processed/acs.parquet", "data/processed/roads/**/*.parquet",
+                                         "data/interim/pumas.parquet", "data/processed/geojson/*.json"])
+        self.checked = (time.monotonic(), version)
+        return version
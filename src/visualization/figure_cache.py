@@ -0,0 +1,176 @@
+from collections import OrderedDict
+from src.data.data_store import DataStore
+import threading
+import hashlib
+import shutil
+import json
+import os
+
+
+class FigureCache:
+    """
+    A two-tier cache of rendered figures, or other JSON payloads, keyed by the callback inputs. The first tier is an
+    in-process LRU; the second is a directory of JSON files shared by every worker on the
+    host. Entries live under a directory named after the data version, so a data refresh
+    starts a new cache and `prune` removes the ones older than the previous version.
+
+    The version is fixed when the cache is created and should be the version of the data the
+    process loaded. DataGraph does not reload its data, so after a refresh the app must be
+    restarted to serve and cache the new figures; `/metrics/figures` reports when it is due.
+
+    Parameters
+    ----------
+    version : str
+        A fingerprint of the data the figures are built from.
+    path : str, optional
+        The root of the on-disk tier. The default is "data/processed/figures".
+    size : int, optional
+        Maximum number of figures held in memory. The default is 256.
+    debug : bool, optional
+        If True, enables debug messages. The default is False.
+    """
+
+    def __init__(self, version: str, path="data/processed/figures", size=256, debug=False):
+        """
+        Initializes the FigureCache class and creates the on-disk tier of the current version.
+        """
+        self.version = version[:16]
+        self.path = path
+        self.directory = os.path.join(path, self.version)
+        self.size = size
+        self.debug = debug
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.metrics = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(params: dict) -> str:
+        """
+        Returns the cache key of a set of callback inputs.
+        """
+        return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, params: dict, build) -> dict:
+        """
+        Returns the figure of the given inputs from memory or disk, building and storing it on a miss.
+
+        Parameters
+        ----------
+        params : dict
+            The callback inputs the figure depends on.
+        build : callable
+            Called without arguments on a miss; must return a plotly figure or a JSON-serializable object.
+
+        Returns
+        -------
+        dict
+            The figure or payload as a JSON-compatible object.
+        """
+        key = self.key(params)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.metrics["memory_hits"] += 1
+                return self.memory[key]
+
+        filename = os.path.join(self.directory, f"{key}.json")
+        figure = self.read(filename)
+        tier = "disk_hits"
+        if figure is None:
+            result = build()
+            payload = result.to_json() if hasattr(result, "to_json") else json.dumps(result)
+            self.write(filename, payload)
+            figure = json.loads(payload)
+            tier = "misses"
+
+        with self.lock:
+            self.metrics[tier] += 1
+            self.memory[key] = figure
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.size:
+                self.memory.popitem(last=False)
+        if self.debug:
+            print("\033[0;36mNOTICE: \033[0m" + f"Figure cache {tier.replace('_', ' ')} for {params}")
+        return figure
+
+    @staticmethod
+    def read(filename: str):
+        """
+        Reads a figure from the on-disk tier, or returns None if it is missing or unreadable.
+        """
+        try:
+            with open(filename, "r") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def write(self, filename: str, payload: str) -> None:
+        """
+        Writes a figure to the on-disk tier atomically. The directory is recreated if another
+        process pruned it, and a failed write only leaves the figure out of the disk tier.
+        """
+        try:
+            with DataStore.atomic_write(filename) as tmp, open(tmp, "w") as file:
+                file.write(payload)
+        except OSError as error:
+            print("\033[1;33mWARNING: \033[0m" + f"Could not write {filename} to the figure cache: {error}")
+
+    def stats(self) -> dict:
+        """
+        Returns the hit and miss counts of this process together with the hit rate.
+        """
+        with self.lock:
+            stats = dict(self.metrics, memory_entries=len(self.memory))
+        total = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / total if total else 0.0
+        return stats
+
+    def prune(self) -> None:
+        """
+        Removes the on-disk tiers of old data versions. The current version and the most
+        recently written other version are kept, since workers started before a data refresh
+        still serve the previous one.
+        """
+        others = [os.path.join(self.path, name) for name in os.listdir(self.path)
+                  if name != self.version and os.path.isdir(os.path.join(self.path, name))]
+        others.sort(key=os.path.getmtime, reverse=True)
+        for directory in others[1:]:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def warm(self, combinations: list, build) -> int:
+        """
+        Pre-renders figures into the on-disk tier, e.g. after a data refresh.
+
+        Parameters
+        ----------
+        combinations : list
+            The callback inputs to render, one dict per figure.
+        build : callable
+            Called with the keyword arguments of a combination; must return a plotly figure.
+
+        Returns
+        -------
+        int
+            The number of figures that had to be built.
+        """
+        self.prune()
+        before = self.metrics["misses"]
+        for params in combinations:
+            self.get(params, lambda: build(**params))
+        built = self.metrics["misses"] - before
+        if self.debug:
+            print("\033[0;32mINFO: \033[0m" + f"Warmed {len(combinations)} figures, {built} built")
+        return built
+
+
+if __name__ == "__main__":
+    import polars as pl
+    from src.visualization.data_graph import DataGraph
+
+    # the dropdown defaults (all sexes, all races) are the combinations nearly every visit starts from
+    data = DataGraph()
+    cache = FigureCache(data.version(), debug=True)
+    states = pl.read_parquet("data/external/state_codes.parquet").select("fips").to_series().to_list()
+    cache.warm([{"state": state, "sex": 3, "race": "ALL", "mode": mode, "year": year}
+                for state in states for mode in DataGraph.modes for year in range(2012, 2020)], data.figure)
@@ -0,0 +1,117 @@
+from src.data.data_store import DataStore
+from functools import lru_cache
+import mapbox_vector_tile
+import numpy as np
+import threading
+import shapely
+
+# radius of the spherical web mercator projection, in meters
+RADIUS = 6378137.0
+
+
+class VectorTiles:
+    """
+    Cuts PUMA geometries into Mapbox vector tiles (MVT) on demand. Geometries are read and
+    simplified once per zoom level of `DataStore.geojson_levels`, projected to web mercator
+    and indexed with an STRtree; every tile is then an index query and a clip. The clipped
+    features of recently requested tiles are kept in an LRU cache.
+
+    Parameters
+    ----------
+    path : str, optional
+        The interim PUMA GeoParquet file. The default is "data/interim/pumas.parquet".
+    cache_size : int, optional
+        Number of tiles whose features are kept in memory. The default is 4096.
+    extent : int, optional
+        The integer extent of a tile. The default is 4096.
+    buffer : int, optional
+        The margin, in tile units, clipped around each tile to hide seams. The default is 64.
+    """
+
+    def __init__(self, path="data/interim/pumas.parquet", cache_size=4096, extent=4096, buffer=64):
+        """
+        Initializes the VectorTiles class. Nothing is read until the first tile is requested.
+        """
+        self.path = path
+        self.extent = extent
+        self.buffer = buffer
+        self.lock = threading.Lock()
+        self.levels = {}
+        self.features = lru_cache(maxsize=cache_size)(self.features)
+
+    @staticmethod
+    def mercator(geoms: np.ndarray) -> np.ndarray:
+        """
+        Projects longitude/latitude geometries to web mercator meters.
+        """
+        def project(coords: np.ndarray) -> np.ndarray:
+            lat = np.clip(coords[:, 1], -85.0511, 85.0511)
+            return np.column_stack([
+                np.radians(coords[:, 0]) * RADIUS,
+                np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * RADIUS,
+            ])
+        return shapely.transform(geoms, project)
+
+    @staticmethod
+    def bounds(z: int, x: int, y: int) -> tuple:
+        """
+        Returns the web mercator bounds (xmin, ymin, xmax, ymax) of a z/x/y tile.
+        """
+        size = 2 * np.pi * RADIUS / 2 ** z
+        xmin = -np.pi * RADIUS + x * size
+        ymax = np.pi * RADIUS - y * size
+        return xmin, ymax - size, xmin + size, ymax
+
+    def level(self, z: int) -> tuple:
+        """
+        Returns the PUMA IDs, simplified mercator geometries and STRtree of the zoom level used
+        for tiles at zoom `z`, building them on first use.
+        """
+        level = max([level for level in DataStore.geojson_levels if level <= z] or [min(DataStore.geojson_levels)])
+        with self.lock:
+            if level not in self.levels:
+                pumas = DataStore.read_geoparquet(self.path, columns=["puma_id", "geometry"])
+                tolerance, grid = DataStore.geojson_levels[level]
+                geoms = self.mercator(DataStore.simplify(pumas.geometry.to_numpy(), tolerance, grid))
+                self.levels[level] = (pumas["puma_id"].astype(str).to_numpy(), geoms, shapely.STRtree(geoms))
+            return self.levels[level]
+
+    def features(self, z: int, x: int, y: int) -> tuple:
+        """
+        Returns the PUMA IDs and geometries clipped to a tile and its buffer.
+        """
+        puma_ids, geoms, tree = self.level(z)
+        xmin, ymin, xmax, ymax = self.bounds(z, x, y)
+        margin = (xmax - xmin) * self.buffer / self.extent
+        clip = (xmin - margin, ymin - margin, xmax + margin, ymax + margin)
+        idx = tree.query(shapely.box(*clip), predicate="intersects")
+        clipped = shapely.clip_by_rect(geoms[idx], *clip)
+        keep = ~shapely.is_empty(clipped)
+        return puma_ids[idx[keep]], clipped[keep]
+
+    def tile(self, z: int, x: int, y: int, puma_ids=None) -> bytes:
+        """
+        Encodes a tile with one layer, "pumas", whose features carry their `puma_id`.
+
+        Parameters
+        ----------
+        z, x, y : int
+            The tile coordinates.
+        puma_ids : set, optional
+            If given, only these PUMAs are included. The default is None.
+
+        Returns
+        -------
+        bytes
+            The encoded MVT tile.
+        """
+        ids, geoms = self.features(z, x, y)
+        features = [
+            {"geometry": geom, "properties": {"puma_id": puma_id}}
+            for puma_id, geom in zip(ids, geoms)
+            if puma_ids is None or puma_id in puma_ids
+        ]
+        return mapbox_vector_tile.encode(
+            [{"name": "pumas", "features": features}],
+            default_options={"quantize_bounds": self.bounds(z, x, y), "extents": self.extent},
+        )
@@ -0,0 +1,5 @@
+import sys
+import os
+
+# run the tests against the repository sources, e.g. `from src.data.data_process import DataProcess`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,48 @@
+from src.data.data_process import DataProcess
+from src.data.data_bench import DataBench
+from polars.testing import assert_frame_equal
+import polars as pl
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def acs_files(tmp_path):
+    """
+    Synthetic PUMS records of two years covering both sexes, every race flag, every travel
+    mode and records without a commute (JWMNP == 0), one raw file per year.
+    """
+    rng = np.random.default_rng(2024)
+    races = ["RACAIAN", "RACASN", "RACBLK", "RACNUM", "RACWHT", "RACSOR", "HISP"]
+    files = []
+    for year, adjinc in [(2012, "1042852"), (2013, "1.024286")]:
+        n = 48
+        df = pl.DataFrame({
+            "year": [year] * n,
+            "state": rng.choice([6, 72], n),
+            "PUMA": rng.choice([101, 102], n),
+            "SEX": np.tile([1, 2], n // 2),
+            "PWGTP": rng.integers(1, 200, n),
+            "JWTR": np.resize(np.arange(1, 13), n),
+            "JWMNP": np.where(np.arange(n) % 5 == 0, 0, rng.integers(1, 90, n)),
+            "HINCP": rng.integers(0, 150_000, n),
+            "ADJINC": [adjinc] * n,
+            **{race: rng.integers(0, 2, n) for race in races},
+        }, schema_overrides={"year": pl.Int64})
+        path = tmp_path / f"acs_{year}.parquet"
+        df.write_parquet(path)
+        files.append(str(path))
+    return files
+
+
+def test_aggregate_acs_matches_legacy_loop(acs_files):
+    deflators = pl.DataFrame({"year": [2012, 2013], "deflator": [1.08, 1.05]})
+    keys = ["year", "state", "PUMA", "sex", "race"]
+
+    legacy = DataBench.legacy_acs(acs_files, deflators).sort(keys)
+    single = DataProcess.aggregate_acs(pl.scan_parquet(acs_files), deflators).collect()
+    single = single.select(legacy.columns).sort(keys)
+
+    assert single.filter(pl.col("sex") != 3)["sex"].unique().to_list() == [1, 2]
+    assert set(single["race"]) == {"RACAIAN", "RACASN", "RACBLK", "RACNUM", "RACWHT", "RACSOR", "HISP", "ALL"}
+    assert_frame_equal(single, legacy)
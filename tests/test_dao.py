@@ -0,0 +1,88 @@
+from contextlib import contextmanager
+import geopandas as gpd
+import pandas as pd
+import shapely
+import pytest
+import uuid
+import os
+
+pytest.importorskip("psycopg2")
+from src.data.data_db_dao import DAO  # noqa: E402 (loads .env)
+
+pytestmark = pytest.mark.skipif(
+    not os.environ.get("POSTGRES_HOST"),
+    reason="needs a PostGIS server, e.g. `docker compose up db` with POSTGRES_* set in .env",
+)
+
+
+@contextmanager
+def repo_root():
+    """
+    Runs a block from the repository root, where the DAO finds src/data/schema.sql.
+    """
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture(scope="module")
+def dao():
+    """
+    A DAO on a throwaway schema, dropped with everything in it after the tests.
+    """
+    schema = f"test_{uuid.uuid4().hex[:12]}"
+    with repo_root():
+        dao = DAO(schema=schema, connections=2)
+    yield dao
+    with dao.connection() as conn, conn.cursor() as cursor:
+        cursor.execute(f'DROP SCHEMA "{schema}" CASCADE;')
+    dao.engine.dispose()
+
+
+def roads(year: int, lines: list) -> gpd.GeoDataFrame:
+    """
+    A roads frame in the layout of `DAO.frame_roads`, in EPSG:3857 so lengths are exact.
+    """
+    return gpd.GeoDataFrame({
+        "linear_id": [f"{year}{i:010d}" for i in range(len(lines))],
+        "year": pd.to_datetime([str(year)] * len(lines), format="%Y"),
+    }, geometry=lines, crs=3857)
+
+
+def fetch(dao: DAO, query: str) -> list:
+    with dao.connection() as conn, conn.cursor() as cursor:
+        cursor.execute(query)
+        return cursor.fetchall()
+
+
+def test_copy_frame_in_chunks(dao):
+    gdf = roads(2012, [shapely.LineString([(0, 0), (3, 4)]), shapely.LineString([(0, 0), (0, 2)]),
+                       shapely.LineString([(1, 1), (1, 2)])])
+    with dao.connection() as conn, conn.cursor() as cursor:
+        cursor.execute("CREATE TABLE copied (linear_id text, year timestamptz, geometry geometry(LineString, 3857));")
+        assert DAO.copy_frame(cursor, "copied", gdf, chunk_size=2) == 3
+    assert fetch(dao, "SELECT count(*), sum(ST_Length(geometry)) FROM copied;") == [(3, 8.0)]
+
+
+def test_bulk_load_records_and_skips_loaded_files(dao, tmp_path):
+    files = []
+    for year, lines in [(2012, [shapely.LineString([(0, 0), (3, 4)])]),
+                        (2013, [shapely.LineString([(0, 0), (0, 2)]), shapely.LineString([(0, 0), (6, 8)])])]:
+        path = tmp_path / f"roads_{year}_06001.parquet"
+        roads(year, lines).to_parquet(path)
+        files.append(str(path))
+
+    assert dao.bulk_load("roads_table", files, gpd.read_parquet) == 3
+    assert fetch(dao, "SELECT extract(year FROM year)::int, count(*), sum(ST_Length(geometry)) "
+                      "FROM roads_table GROUP BY 1 ORDER BY 1;") == [(2012, 1, 5.0), (2013, 2, 12.0)]
+    assert fetch(dao, "SELECT source, rows, status FROM load_ledger WHERE table_name = 'roads_table' "
+                      "ORDER BY source;") == [("roads_2012_06001.parquet", 1, "loaded"),
+                                               ("roads_2013_06001.parquet", 2, "loaded")]
+    assert dao.ledger("roads_table") == {os.path.basename(file): dao.cache.sha256(file) for file in files}
+
+    # a second run finds both files in the ledger and loads nothing
+    assert dao.bulk_load("roads_table", files, gpd.read_parquet) == 0
+    assert fetch(dao, "SELECT count(*) FROM roads_table;") == [(3,)]
@@ -0,0 +1,171 @@
+from src.data.data_download import DataDownload
+from src.data.data_cache import DataCache
+from requests.exceptions import RequestException
+import http.server
+import threading
+import hashlib
+import pytest
+import os
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves `files` by path, counting the requests of every path. Paths starting with
+    /flaky/ fail with 503 twice before succeeding, /truncated/ sends fewer bytes than its
+    Content-Length and /missing/ always answers 404.
+    """
+
+    files = {}
+    hits = {}
+
+    def do_GET(self):
+        hits = self.hits[self.path] = self.hits.get(self.path, 0) + 1
+        body = self.files.get(self.path.rsplit("/", 1)[-1], b"")
+        etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+        if self.path.startswith("/missing/"):
+            self.send_error(404)
+        elif self.path.startswith("/flaky/") and hits <= 2:
+            self.send_error(503)
+        elif self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(body[:len(body) // 2] if self.path.startswith("/truncated/") else body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """
+    A local stand-in for the Census servers, with the working directory in a temporary folder.
+    """
+    monkeypatch.chdir(tmp_path)
+    Handler.files = {"a.zip": b"a" * 5000, "b.zip": b"b" * 3000}
+    Handler.hits = {}
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def leftovers(directory=".") -> list:
+    return [file for file in os.listdir(directory) if file.startswith(".")]
+
+
+def test_retries_server_errors_with_backoff(server):
+    downloader = DataDownload(workers=1, retries=3, backoff=0.01)
+    assert downloader.fetch(f"{server}/flaky/a.zip", "a.zip") == 5000
+    assert Handler.hits["/flaky/a.zip"] == 3
+    with open("a.zip", "rb") as file:
+        assert file.read() == Handler.files["a.zip"]
+
+    downloader = DataDownload(workers=1, retries=1, backoff=0.01)
+    with pytest.raises(RequestException):
+        downloader.fetch(f"{server}/flaky/b.zip", "b.zip")
+    assert Handler.hits["/flaky/b.zip"] == 2
+    assert not os.path.exists("b.zip")
+
+
+def test_truncated_transfer_keeps_previous_file(server):
+    with open("a.zip", "wb") as file:
+        file.write(b"previous")
+    downloader = DataDownload(workers=1, retries=2, backoff=0.01)
+    with pytest.raises(RequestException):
+        downloader.fetch(f"{server}/truncated/a.zip", "a.zip")
+    assert Handler.hits["/truncated/a.zip"] == 3
+    with open("a.zip", "rb") as file:
+        assert file.read() == b"previous"
+    assert leftovers() == []
+
+
+def test_download_replaces_file_atomically(server):
+    with open("a.zip", "wb") as file:
+        file.write(b"previous")
+    downloader = DataDownload(workers=1, retries=0)
+    assert downloader.fetch(f"{server}/files/a.zip", "a.zip") == 5000
+    with open("a.zip", "rb") as file:
+        assert file.read() == Handler.files["a.zip"]
+    assert oct(os.stat("a.zip").st_mode & 0o777) == oct(0o644)
+    assert leftovers() == []
+
+
+def test_revalidation_of_unchanged_files(server):
+    cache = DataCache(path="manifest.json")
+    downloader = DataDownload(workers=2, retries=0, cache=cache)
+    jobs = [(f"{server}/files/a.zip", "a.zip"), (f"{server}/files/b.zip", "b.zip")]
+    assert downloader.fetch_all(jobs)["downloaded"] == 2
+
+    # cached files need no request at all unless they are revalidated
+    assert downloader.fetch_all(jobs)["skipped"] == 2
+    stats = downloader.fetch_all(jobs, revalidate=True)
+    assert (stats["unchanged"], stats["bytes"]) == (2, 0)
+    assert Handler.hits["/files/a.zip"] == 2
+
+    Handler.files["a.zip"] = b"A" * 4000
+    stats = downloader.fetch_all(jobs, revalidate=True)
+    assert (stats["downloaded"], stats["unchanged"], stats["bytes"]) == (1, 1, 4000)
+    assert cache.get("a.zip")["sha256"] == hashlib.sha256(Handler.files["a.zip"]).hexdigest()
+
+
+def test_unavailable_files_are_not_failures(server):
+    downloader = DataDownload(workers=2, retries=3, backoff=0.01)
+    stats = downloader.fetch_all([(f"{server}/files/a.zip", "a.zip"), (f"{server}/missing/b.zip", "b.zip")])
+    assert (stats["downloaded"], stats["unavailable"], stats["failed"]) == (1, 1, 0)
+    # a 404 is not retried
+    assert Handler.hits["/missing/b.zip"] == 1
+
+
+def test_duplicate_payloads_share_an_inode(server):
+    Handler.files["c.zip"] = Handler.files["a.zip"]
+    cache = DataCache(path="manifest.json")
+    downloader = DataDownload(workers=1, retries=0, cache=cache)
+    downloader.fetch_all([(f"{server}/files/a.zip", "a.zip"), (f"{server}/files/c.zip", "c.zip")])
+    assert os.stat("a.zip").st_ino == os.stat("c.zip").st_ino
+    assert leftovers() == []
+
+    # a reloaded manifest keeps both entries and the validators
+    reloaded = DataCache(path="manifest.json")
+    assert reloaded.get("c.zip")["sha256"] == reloaded.get("a.zip")["sha256"]
+    assert reloaded.get("a.zip")["etag"] and reloaded.get("a.zip")["url"] == f"{server}/files/a.zip"
+
+
+def test_link_copies_when_hard_links_fail(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name, payload in [("a.zip", b"same"), ("c.zip", b"old")]:
+        with open(name, "wb") as file:
+            file.write(payload)
+
+    def refuse(source, destination):
+        raise OSError("cross-device link")
+
+    monkeypatch.setattr(os, "link", refuse)
+    DataCache.link("a.zip", "c.zip")
+    with open("c.zip", "rb") as file:
+        assert file.read() == b"same"
+    assert os.stat("a.zip").st_ino != os.stat("c.zip").st_ino
+    assert leftovers() == []
+
+
+def test_verify_drops_truncated_files(server):
+    cache = DataCache(path="manifest.json")
+    downloader = DataDownload(workers=2, retries=0, cache=cache)
+    jobs = [(f"{server}/files/a.zip", "a.zip"), (f"{server}/files/b.zip", "b.zip")]
+    downloader.fetch_all(jobs)
+    with open("b.zip", "r+b") as file:
+        file.truncate(100)
+
+    assert cache.verify() == ["b.zip"]
+    assert cache.get("b.zip") is None
+    stats = downloader.fetch_all(jobs)
+    assert (stats["skipped"], stats["downloaded"]) == (1, 1)
+    assert Handler.hits["/files/b.zip"] == 2
+    assert os.path.getsize("b.zip") == len(Handler.files["b.zip"])
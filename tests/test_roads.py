@@ -0,0 +1,73 @@
+from src.data.data_process import DataProcess
+from src.data.data_pipeline import Stage
+from src.data.data_store import DataStore
+import geopandas as gpd
+import polars as pl
+import numpy as np
+import zipfile
+import shapely
+import pytest
+import os
+
+
+def write_roads(directory, year: int, county_id: str, lines: list) -> None:
+    """
+    Writes a zipped road shapefile in the layout of data/shape_files.
+    """
+    gdf = gpd.GeoDataFrame({"LINEARID": [f"{i:014d}" for i in range(len(lines))]}, geometry=lines, crs=4269)
+    shp = directory.parent / f"shp_{year}_{county_id}"
+    shp.mkdir()
+    gdf.to_file(shp / "roads.shp", engine="pyogrio")
+    with zipfile.ZipFile(directory / f"roads_{year}_{county_id}.zip", "w") as archive:
+        for file in os.listdir(shp):
+            archive.write(shp / file, file)
+
+
+@pytest.fixture
+def pumas(tmp_path, monkeypatch):
+    """
+    Two PUMAs side by side and road files for 2012 and 2014 only, so 2013 has no roads.
+    """
+    shape_files = tmp_path / "data" / "shape_files"
+    shape_files.mkdir(parents=True)
+    write_roads(shape_files, 2012, "06001", [shapely.LineString([(0.5, 0.5), (1.5, 0.5)])])
+    write_roads(shape_files, 2014, "06001", [shapely.LineString([(0.5, 0.5), (1.5, 0.5)]),
+                                             shapely.LineString([(0.5, 0.2), (0.5, 0.8)])])
+    monkeypatch.chdir(tmp_path)
+    polygons = np.array([shapely.box(0, 0, 1, 1), shapely.box(1, 0, 2, 1)])
+    return ["0600101", "0600102"], shapely.to_wkb(polygons)
+
+
+def test_incremental_matches_full_with_missing_year(pumas):
+    puma_ids, puma_wkb = pumas
+    years = [2012, 2013, 2014]
+    incremental = pl.read_ipc(DataProcess.road_length_state("06", years, puma_ids, puma_wkb))
+    full = pl.concat([pl.read_ipc(DataProcess.road_length_partition("06", year, puma_ids, puma_wkb))
+                      for year in years])
+
+    joined = full.join(incremental, on=["year", "puma_id"], suffix="_incremental").sort("year", "puma_id")
+    assert len(joined) == len(years) * len(puma_ids)
+    assert np.allclose(joined["length"].to_numpy(), joined["length_incremental"].to_numpy())
+    assert joined.filter(pl.col("year") == 2013)["length_incremental"].to_list() == [0.0, 0.0]
+
+
+def test_incremental_first_year_without_roads(pumas):
+    puma_ids, puma_wkb = pumas
+    incremental = pl.read_ipc(DataProcess.road_length_state("06", [2011, 2012], puma_ids, puma_wkb))
+    assert incremental.filter(pl.col("year") == 2011)["length"].to_list() == [0.0, 0.0]
+    assert incremental.filter(pl.col("year") == 2012)["length"].sum() == pytest.approx(1.0)
+
+
+def test_read_roads_after_outputs_removed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    DataStore.write_roads(pl.DataFrame({"year": [2012, 2013], "state_id": ["06", "06"],
+                                        "puma_id": ["0600101", "0600101"], "length": [1.0, 2.0]}))
+    assert DataStore.read_roads(years=[2013])["length"].to_list() == [2.0]
+
+    Stage("process_roads", print, outputs=[f"{DataStore.roads_path}/**/*.parquet"]).remove_outputs()
+    assert os.listdir(DataStore.roads_path) == []
+    # partition directories left without files must not break the schema either
+    os.makedirs(os.path.dirname(DataStore.road_partition(2012, "06")))
+    roads = DataStore.read_roads()
+    assert roads.is_empty()
+    assert roads.schema == {"year": pl.Int64, "state_id": pl.String, "puma_id": pl.String, "length": pl.Float64}
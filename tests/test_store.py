@@ -0,0 +1,20 @@
+from src.data.data_store import DataStore
+import numpy as np
+import shapely
+
+
+def test_simplify_keeps_shared_borders():
+    # two squares meeting along a noisy border that both sides must simplify the same way
+    rng = np.random.default_rng(0)
+    border = [(1, 0), *[(1 + 0.03 * rng.standard_normal(), i / 40) for i in range(1, 40)], (1, 1)]
+    left = shapely.Polygon([(0, 0), *border, (0, 1)])
+    right = shapely.Polygon([(2, 0), (2, 1), *reversed(border)])
+    geoms = DataStore.simplify(np.array([left, right]), tolerance=0.05, grid=0.001)
+
+    assert all(len(shapely.get_coordinates(geom)) < len(shapely.get_coordinates(source))
+               for geom, source in zip(geoms, [left, right]))
+    # no slivers where they overlap and no gaps between them
+    union = shapely.union_all(geoms)
+    assert shapely.intersection(geoms[0], geoms[1]).area == 0
+    assert shapely.get_num_interior_rings(union) == 0
+    assert np.isclose(union.area, 2.0)